@@ -18,6 +18,7 @@ limitations under the License.
 
 import collections
 import logging
+import time
 from sqlalchemy.event import listen
 
 from . exc import (TransactionError,
@@ -32,6 +33,8 @@ class ActivityLog(object):
         self.log = logging.getLogger("{}.ActivityLog".format(__name__))
         self.log.debug("Created an activitylog")
         self._actions = collections.deque()
+        # seconds spent running actions, by kind of action
+        self.timings = collections.defaultdict(float)
         self.active = False
         self.autobegin = autobegin
         if autobegin:
@@ -59,6 +62,8 @@ class ActivityLog(object):
             self.add(action, *args, **kwargs)
 
     def add(self, action, *args, **kwargs):
+        start = time.time()
+        a = None
         try:
             a = action(*args, **kwargs)
 
@@ -74,6 +79,10 @@ class ActivityLog(object):
         else:
             self._actions.append(a)
 
+        finally:
+            kind = getattr(a, 'kind', getattr(action, 'kind', 'action'))
+            self.timings[kind] += time.time() - start
+
     def begin(self):
         self.active = True
         self._actions.clear()
@@ -121,6 +130,7 @@ class ActivityLog(object):
                 except IndexError:
                     break
 
+                start = time.time()
                 try:
                     action.commit()
 
@@ -128,6 +138,10 @@ class ActivityLog(object):
                     self.log.exception("Error in commit")
                     self.rollback(exc=exc)
 
+                finally:
+                    self.timings[getattr(action, 'kind', 'action')] += \
+                            time.time() - start
+
         finally:
             if self.autobegin:
                 self.begin()
@@ -24,6 +24,9 @@ __all__ = ['Action']
 
 class Action(object):
 
+    # actions are timed by kind
+    kind = 'action'
+
     def __init__(self):
         self.name = self.__class__.__name__
         self.log = logging.getLogger("{}.{}".format(self.__class__.__module__,
@@ -19,12 +19,15 @@ limitations under the License.
 import shlex
 import subprocess
 from . action import Action
+from . process import run
 
 __all__ = ['command']
 
 
 class command(Action):
 
+    kind = 'command'
+
     def __init__(self, cmd, *args, **kwargs):
         super(command, self).__init__()
         self.cmd = cmd
@@ -39,8 +42,7 @@ class command(Action):
     def run(self):
         try:
             self.log.info("Executing <%s>", self.cmd)
-            subprocess.check_call(shlex.split(self.cmd),
-                                  *self.args, **self.kwargs)
+            run(shlex.split(self.cmd), *self.args, **self.kwargs)
 
         except subprocess.CalledProcessError as e:
             self.log.error("Error while executing cmd: %s: %s",
@@ -20,7 +20,9 @@ import os.path
 from aybu.manager.activity_log.command import command
 
 
-def dump_database(config, dump_dir, dump_name=None):
+def dump_database(config, dump_dir, dump_name=None, prefix=None):
+    """ prefix is prepended to the dump command, i.e. to run it
+        through nice """
     dump_name = config.type if not dump_name else dump_name
     dump_name = "{}.sql".format(dump_name)
     dump_path = os.path.join(dump_dir, dump_name)
@@ -35,6 +37,8 @@ def dump_database(config, dump_dir, dump_name=None):
     else:
         raise ValueError("Invalid db type {}".format(config.type))
 
+    if prefix:
+        dump_cmd = "{} {}".format(prefix, dump_cmd)
     return command(dump_cmd, on_init=True)
 
 
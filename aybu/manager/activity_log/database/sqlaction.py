@@ -21,6 +21,8 @@ from sqlalchemy.orm import class_mapper
 
 class SQLAction(object):
 
+    kind = 'sql'
+
     def __new__(cls, type_, what, init=None, commit=None, rollback=None,
                 config=None, session=None):
         what = what.replace("_", " ").title().replace(" ", "")
@@ -27,6 +27,8 @@ __all__ = ['mkdir', 'create', 'copy', 'rm', 'rmdir', 'rmtree']
 
 class FSAction(Action):
 
+    kind = 'fs'
+
     def __init__(self, path):
         super(FSAction, self).__init__()
         self.path = path
@@ -22,6 +22,7 @@ import shlex
 import shutil
 import subprocess
 from . action import Action
+from . process import run
 
 
 __all__ = ['install', 'uninstall']
@@ -29,6 +30,8 @@ __all__ = ['install', 'uninstall']
 
 class Pip(Action):
 
+    kind = 'pip'
+
     def __init__(self, path, virtualenv, package_name):
         super(Pip, self).__init__()
         self.python = os.path.join(virtualenv, 'bin', 'python')
@@ -44,7 +47,7 @@ class Pip(Action):
         self.log.info("installing from %s", self.path)
         self.log.debug(command)
         try:
-            subprocess.check_output(shlex.split(command))
+            run(shlex.split(command), capture=True)
 
         except subprocess.CalledProcessError as e:
             self.log.error(e.output)
@@ -54,7 +57,7 @@ class Pip(Action):
         cmd = "{} {} uninstall -y {}".format(self.python, self.script,
                                           self.package_name)
         self.log.info("uninstall: %s", self.package_name)
-        subprocess.check_call(shlex.split(cmd))
+        run(shlex.split(cmd))
         # remove egg_info directory
         egginfo_dir = "{}.egg-info".format(self.package_name.replace("-", "_"))
         egginfo_dir = os.path.join(self.path, egginfo_dir)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import subprocess
+import threading
+import time
+from aybu.manager.exc import (TaskCancelledError,
+                              TaskTimeoutError)
+
+
+__all__ = ['run', 'set_limits', 'clear_limits', 'get_limits',
+           'check_limits']
+log = logging.getLogger(__name__)
+_local = threading.local()
+
+
+def set_limits(deadline=None, cancelled=None):
+    """ Sets the limits of the task executed by the current thread:
+        the time (as returned by time.time()) it must end by, and a
+        callable returning True when the task has been cancelled.
+        Pass (deadline, cancelled) as returned by get_limits() to share
+        them with helper threads. """
+    _local.limits = (deadline, cancelled)
+
+
+def clear_limits():
+    _local.limits = (None, None)
+
+
+def get_limits():
+    return getattr(_local, 'limits', (None, None))
+
+
+def check_limits():
+    """ raises TaskTimeoutError or TaskCancelledError if the task running
+        in the current thread has exceeded its limits """
+    deadline, cancelled = get_limits()
+    if deadline is not None and time.time() > deadline:
+        raise TaskTimeoutError("Task timed out")
+    if cancelled is not None and cancelled():
+        raise TaskCancelledError("Task cancelled")
+
+
+def run(args, *popenargs, **kwargs):
+    """ Like subprocess.check_call (or check_output, if capture is True),
+        but the process is killed, and TaskTimeoutError or
+        TaskCancelledError raised, as soon as the task running in the
+        current thread exceeds its limits.
+    """
+    capture = kwargs.pop('capture', False)
+    poll_interval = kwargs.pop('poll_interval', 0.5)
+    if capture:
+        kwargs['stdout'] = subprocess.PIPE
+
+    process = subprocess.Popen(args, *popenargs, **kwargs)
+    output = []
+    reader = None
+    if capture:
+        reader = threading.Thread(
+                    target=lambda: output.append(process.stdout.read()))
+        reader.daemon = True
+        reader.start()
+
+    try:
+        # short commands should not pay for a whole poll interval
+        interval = 0.01
+        while process.poll() is None:
+            check_limits()
+            time.sleep(interval)
+            interval = min(interval * 2, poll_interval)
+
+    except (TaskTimeoutError, TaskCancelledError) as e:
+        log.error("Killing <%s> (pid %d): %s", " ".join(args), process.pid,
+                  e)
+        process.kill()
+        process.wait()
+        raise
+
+    finally:
+        if reader:
+            reader.join()
+
+    output = "".join(output)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args,
+                                            output=output)
+
+    return output if capture else process.returncode
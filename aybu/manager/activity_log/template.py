@@ -26,6 +26,8 @@ __all__ = ['render']
 
 class render(Action):
 
+    kind = 'render'
+
     def __init__(self, template_name, target, deferred=False,
                  skip_rollback=False, perms=None, **params):
         super(render, self).__init__()
@@ -70,6 +70,6 @@ def start():
 
     finally:
         if daemon:
-            daemon.worker._Thread__stop()
+            daemon.stop()
         sys.exit(exit_status)
 
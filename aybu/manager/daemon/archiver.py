@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import logging
+import threading
+import time
+from sqlalchemy import engine_from_config
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from aybu.manager.models import ArchivedTask
+from aybu.manager.task import Task
+
+
+class TaskArchiver(threading.Thread):
+    """ Moves the tasks completed more than 'tasks.retention' seconds ago
+        from redis to the tasks_archive table, 'tasks.archive.batch' tasks
+        at time, every 'tasks.archive.interval' seconds. Only the last
+        'tasks.archive.log_lines' log lines of every task are kept.
+    """
+
+    def __init__(self, config, redis_client):
+        super(TaskArchiver, self).__init__(name='archiver')
+        self.log = logging.getLogger(__name__)
+        self.config = config
+        self.redis = redis_client
+        self.retention = int(config.get('tasks.retention', 0))
+        self.batch = int(config.get('tasks.archive.batch', 500))
+        self.interval = int(config.get('tasks.archive.interval', 60))
+        self.log_lines = int(config.get('tasks.archive.log_lines', 500))
+        self.daemon = True
+
+    @property
+    def enabled(self):
+        return self.retention > 0
+
+    def run(self):
+        engine = engine_from_config(dict(self.config,
+                                         **{'sqlalchemy.poolclass': NullPool}),
+                                    'sqlalchemy.')
+        Session = sessionmaker(bind=engine)
+
+        while True:
+            try:
+                while self.archive(Session()) == self.batch:
+                    pass
+
+            except Exception:
+                self.log.exception("Error archiving tasks")
+
+            time.sleep(self.interval)
+
+    def archive(self, session):
+        """ archive a batch of tasks. Returns the number of archived tasks.
+            Tasks are removed from redis only once they have been stored;
+            those that cannot be converted are stored without their fields
+            and logs.
+        """
+        uuids = Task.done_before(time.time() - self.retention, self.batch,
+                                 redis_client=self.redis)
+        if not uuids:
+            session.close()
+            return 0
+
+        pipe = self.redis.pipeline(transaction=False)
+        for uuid in uuids:
+            key, logs_key = Task.keys_for(uuid)[:2]
+            pipe.hgetall(key)
+            pipe.llen(logs_key)
+            pipe.lrange(logs_key, -self.log_lines, -1)
+        results = pipe.execute()
+
+        archived = []
+        try:
+            for i, uuid in enumerate(uuids):
+                fields, length, entries = results[i * 3:i * 3 + 3]
+                if not fields:
+                    # already removed
+                    archived.append(uuid)
+                    continue
+
+                try:
+                    task = self.archived_task(uuid, fields, length, entries)
+
+                except Exception:
+                    # it would fail again in every batch
+                    self.log.exception("Cannot archive task %s, archiving "
+                                       "it without fields and logs", uuid)
+                    try:
+                        task = self.minimal_archived_task(uuid, fields)
+
+                    except Exception:
+                        self.log.exception("Cannot archive task %s", uuid)
+                        continue
+
+                session.merge(task)
+                archived.append(uuid)
+            session.commit()
+
+        except:
+            session.rollback()
+            raise
+
+        finally:
+            session.close()
+
+        if archived:
+            Task.remove_many(archived, redis_client=self.redis)
+        self.log.info("Archived %d tasks", len(archived))
+        return len(archived)
+
+    @staticmethod
+    def text(value):
+        """ values and logs are bytes, not always utf-8 """
+        if isinstance(value, str):
+            return value.decode('utf-8', 'replace')
+        return value
+
+    def minimal_archived_task(self, uuid, fields):
+        """ the archived task, without fields and logs """
+        command, status = [self.text(fields.get(key, ''))
+                           for key in ('command', 'status')]
+        return ArchivedTask(uuid=uuid, command=command, status=status,
+                            fields=json.dumps(dict(command=command,
+                                                   status=status)),
+                            logs=json.dumps([]))
+
+    def archived_task(self, uuid, fields, length, entries):
+        if length:
+            logs = [Task.decode_log(entry) for entry in entries]
+        else:
+            # logs written by older versions, if any
+            logs = Task.legacy_logs(uuid, self.redis)
+            length = len(logs)
+            logs = logs[-self.log_lines:]
+        logs = [(levelno, self.text(msg)) for levelno, msg in logs]
+        if length > len(logs):
+            logs.insert(0, (logging.WARNING,
+                            "{} log lines not archived"
+                            .format(length - len(logs))))
+
+        fields = {self.text(k): self.text(Task.decode_value(v))
+                  for k, v in fields.iteritems()}
+        return ArchivedTask(uuid=uuid,
+                            command=fields.get('command', ''),
+                            status=fields.get('status', ''),
+                            requested=Task.parse_datetime(
+                                                fields.get('requested')),
+                            started=Task.parse_datetime(fields.get('started')),
+                            finished=Task.parse_datetime(
+                                                fields.get('finished')),
+                            fields=json.dumps(fields),
+                            logs=json.dumps(logs))
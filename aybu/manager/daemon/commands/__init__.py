@@ -15,3 +15,93 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+
+import collections
+import inspect
+import logging
+import pkgutil
+import threading
+from aybu.manager.exc import ParamsError
+
+
+__all__ = ['Command', 'load_commands', 'get_commands']
+log = logging.getLogger(__name__)
+_commands = None
+_commands_lock = threading.Lock()
+
+
+class Command(collections.namedtuple('Command', ['name', 'function', 'args',
+                                                 'required'])):
+    """ A command executed by the workers: a public function of the modules
+        of this package, named '$module.$function', whose first arguments
+        are the session and the task; 'args' are the names of the
+        remaining ones, 'required' those without defaults.
+    """
+
+    @classmethod
+    def from_function(cls, name, function):
+        """ Returns the Command, or None if the function signature is not
+            the one of a command """
+        spec = inspect.getargspec(function)
+        if spec.args[:2] != ['session', 'task'] or spec.varargs \
+           or spec.keywords:
+            return None
+
+        args = tuple(spec.args[2:])
+        defaults = len(spec.defaults or ())
+        required = args[:len(args) - defaults]
+        return cls(name, function, args, required)
+
+    def check_args(self, args):
+        """ raises ParamsError if args do not match the command arguments """
+        unknown = set(args) - set(self.args)
+        if unknown:
+            raise ParamsError("Invalid arguments for {}: {}"
+                              .format(self.name, ", ".join(sorted(unknown))))
+
+        missing = set(self.required) - set(args)
+        if missing:
+            raise ParamsError("Missing arguments for {}: {}"
+                              .format(self.name, ", ".join(sorted(missing))))
+
+    def to_dict(self):
+        return dict(args=list(self.args), required=list(self.required),
+                    description=inspect.getdoc(self.function) or '')
+
+    def __call__(self, session, task, **kwargs):
+        return self.function(session, task, **kwargs)
+
+
+def load_commands():
+    """ imports all the modules of the package and returns the dict
+        '$module.$function' => Command """
+    commands = {}
+    for _, module_name, is_package in pkgutil.iter_modules(__path__):
+        if is_package:
+            continue
+
+        module = __import__("{}.{}".format(__name__, module_name),
+                            fromlist=[module_name])
+        for name, function in vars(module).iteritems():
+            if name.startswith('_') or not inspect.isfunction(function) or \
+               function.__module__ != module.__name__:
+                continue
+
+            command_name = "{}.{}".format(module_name, name)
+            command = Command.from_function(command_name, function)
+            if command is None:
+                log.warning("Skipping %s: invalid signature", command_name)
+                continue
+
+            commands[command_name] = command
+
+    return commands
+
+
+def get_commands():
+    """ the commands, loaded on the first call """
+    global _commands
+    with _commands_lock:
+        if _commands is None:
+            _commands = load_commands()
+        return _commands
@@ -30,12 +30,17 @@ def create(session, task, domain, instance_id):
     return alias.domain
 
 
-def delete(session, task, domain):
+def delete(session, task, domain, owner_id=None):
+    """ owner_id, the instance serving the alias when the task has been
+        submitted, is only used to lock it """
     alias = Alias.get(session, domain)
     alias.delete()
 
 
-def update(session, task, domain, new_domain=None, instance_id=None):
+def update(session, task, domain, new_domain=None, instance_id=None,
+           owner_id=None):
+    """ owner_id, the instance serving the alias when the task has been
+        submitted, is only used to lock it """
     try:
         alias = Alias.get(session, domain)
         if instance_id:
@@ -20,7 +20,13 @@ from aybu.manager.models import (Environment,
                                  Instance,
                                  Theme,
                                  User)
+from aybu.manager.daemon.fanout import fan_out
+from aybu.manager.migration import MigrationRunner
+import datetime
 import logging
+import os
+import threading
+import time
 log = logging.getLogger(__name__)
 
 
@@ -35,7 +41,7 @@ def deploy(session, task, domain, owner_email, environment_name,
 
     instance = Instance.deploy(session, domain, owner, env, technical_contact,
                                theme, default_language, database_password,
-                               enabled)
+                               enabled, progress=task.progress)
 
     return instance.id
 
@@ -46,14 +52,15 @@ def rewrite(session, task, id):
     else:
         instances = [Instance.get(session, id)]
 
-    envs = {}
-    for instance in instances:
-        if not instance.enabled:
-            continue
-
-        env = instance.environment
-        envs[env.name] = env
-        instance.rewrite(restart_services=False)
+    instances = [instance for instance in instances if instance.enabled]
+    envs = {instance.environment.name: instance.environment
+            for instance in instances}
+    if id == "all":
+        fan_out(session, task, instances,
+                lambda s, instance: instance.rewrite(restart_services=False))
+    else:
+        for instance in instances:
+            instance.rewrite(restart_services=False)
 
     for env in envs.values():
         env.restart_services()
@@ -61,13 +68,14 @@ def rewrite(session, task, id):
 
 def reload(session, task, id, force=False, kill=False):
     if id == 'all':
-        instances = Instance.all(session)
-    else:
-        instances = [Instance.get(session, id)]
+        instances = [i for i in Instance.all(session) if i.enabled]
+        fan_out(session, task, instances,
+                lambda s, instance: instance.reload(force=force, kill=kill))
+        return
 
-    for instance in instances:
-        if instance.enabled:
-            instance.reload(force=force, kill=kill)
+    instance = Instance.get(session, id)
+    if instance.enabled:
+        instance.reload(force=force, kill=kill)
 
 
 def delete(session, task, id, archive=False):
@@ -120,18 +128,102 @@ def change_domain(session, task, id, domain):
 
 
 def migrate(session, task, id, revision):
-    if id == 'all':
-        instances = Instance.all(session)
-    else:
-        instances = [Instance.get(session, id)]
+    if id != 'all':
+        Instance.get(session, id).upgrade_schema(revision)
+        return
 
+    instances = Instance.all(session)
+    if not instances:
+        return
+
+    # environments may use different versions of aybu.core
+    runners = {}
     for instance in instances:
-        instance.upgrade_schema(revision)
+        env = instance.environment
+        if env.name not in runners:
+            runners[env.name] = MigrationRunner(env.paths.migrations)
+
+    upgraded = {}
+
+    def upgrade(instance_session, instance):
+        runner = runners[instance.environment.name]
+        upgraded[instance.domain] = runner.upgrade(instance, revision)
+
+    try:
+        results = fan_out(session, task, instances, upgrade)
+
+    finally:
+        for runner in runners.itervalues():
+            runner.close()
+
+    up_to_date = [domain for domain, result in upgraded.iteritems()
+                  if not result.steps]
+    return "{} upgraded, {} up to date, {} failed"\
+            .format(len(upgraded) - len(up_to_date), len(up_to_date),
+                    len(results) - len(upgraded))
 
 
 def archive(session, task, id, name):
     instance = Instance.get(session, id)
-    instance.archive(name)
+    instance.archive(name, progress=task.progress)
+
+
+def backup(session, task, ids=None, environment=None, domains=None,
+           enabled=None, concurrency=None):
+    """ Archives the instances with the given space separated 'ids', set
+        by the daemon to those matching the filters ('environment' name,
+        'domains' shell patterns, 'enabled') when the task is scheduled,
+        with at most 'concurrency' archives at time
+        ('tasks.backup.concurrency').
+        Subprocesses are throttled with nice and ionice, as configured
+        by 'tasks.backup.nice' and 'tasks.backup.ionice'.
+        The duration and the size of every archive are stored in the
+        'backup.$domain' task fields.
+    """
+    if ids is None:
+        instances = Instance.matching(session, environment, domains, enabled)
+    else:
+        # instances deleted since the task has been scheduled are skipped
+        ids = [int(id_) for id_ in ids.split()]
+        instances = Instance.search(session, filters=(Instance.id.in_(ids),),
+                                    return_query=True).all() if ids else []
+
+    settings = Environment.settings
+    if not concurrency:
+        concurrency = settings.get('tasks.backup.concurrency', 2)
+    throttle = []
+    ionice = settings.get('tasks.backup.ionice', '-c2 -n7').strip()
+    if ionice:
+        throttle.append("ionice {}".format(ionice))
+    nice = int(settings.get('tasks.backup.nice', 10))
+    if nice:
+        throttle.append("nice -n {}".format(nice))
+    throttle = " ".join(throttle)
+
+    now = datetime.datetime.now().strftime('%Y%m%d-%H.%M.%S')
+    summary = {}
+    summary_lock = threading.Lock()
+
+    def archive(instance_session, instance):
+        start = time.time()
+        path = instance.archive("{}-{}".format(instance.domain, now),
+                                session=instance_session,
+                                throttle=throttle or None)
+        with summary_lock:
+            summary[instance.domain] = (time.time() - start,
+                                        os.path.getsize(path))
+
+    results = fan_out(session, task, instances, archive,
+                      concurrency=int(concurrency))
+    for domain, (duration, size) in sorted(summary.iteritems()):
+        log.info("Archived %s in %.1f seconds, %d bytes", domain, duration,
+                 size)
+        task['backup.{}'.format(domain)] = \
+                "{:.1f}s {} bytes".format(duration, size)
+
+    return "{} archived ({} bytes), {} failed".format(
+                len(summary), sum(size for _, size in summary.itervalues()),
+                len(results) - len(summary))
 
 
 def restore(session, task, id, archive_name):
@@ -31,13 +31,17 @@ def create(session, task, source, instance_id, http_code=301, target_path=''):
     return redirect.source
 
 
-def delete(session, task, source):
+def delete(session, task, source, owner_id=None):
+    """ owner_id, the instance serving the redirect when the task has
+        been submitted, is only used to lock it """
     redirect = Redirect.get(session, source)
     redirect.delete()
 
 
 def update(session, task, source, instance_id=None, http_code=None,
-           target_path=None, new_source=None):
+           target_path=None, new_source=None, owner_id=None):
+    """ owner_id, the instance serving the redirect when the task has
+        been submitted, is only used to lock it """
     try:
         redirect = Redirect.get(session, source)
         if instance_id:
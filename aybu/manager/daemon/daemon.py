@@ -16,12 +16,30 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import datetime
+import collections
 import logging
-import redis
 import zmq
-from aybu.manager.task import Task, taskstatus
-from . worker import AybuManagerDaemonWorker
+from sqlalchemy import engine_from_config
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from zmq.devices.basedevice import ThreadDevice
+from aybu.manager.models import (Base,
+                                 Instance)
+from aybu.manager.task import (Task,
+                              TaskQueue,
+                              taskstatus,
+                              redis_client_from_settings)
+from . archiver import TaskArchiver
+from . feeder import (TaskFeeder,
+                      FEEDER_ADDR,
+                      FEEDER_WANT)
+from . scheduler import (TaskScheduler,
+                         keys_conflict,
+                         task_keys,
+                         READ_ONLY_COMMANDS)
+from . timer import TaskTimer
+from . worker import (AybuManagerDaemonWorker,
+                      WORKER_READY)
 
 
 class AybuManagerDaemon(object):
@@ -31,53 +49,277 @@ class AybuManagerDaemon(object):
         self.config = config
         self.log = logging.getLogger(__name__)
         self.context = zmq.Context()
-        self.worker = AybuManagerDaemonWorker(self.context, self.config)
-        redis_opts = {k.replace('redis.', ''): self.config[k]
-                      for k in self.config
-                      if k.startswith('redis.')}
-        if 'port' in redis_opts:
-            redis_opts['port'] = int(redis_opts['port'])
+        self.workers = [AybuManagerDaemonWorker(self.config, index=i)
+                        for i in xrange(int(self.config.get('worker.processes',
+                                                            1)))]
+        self.redis = redis_client_from_settings(self.config)
+        Task.configure(self.config)
+        self.scheduler = TaskScheduler()
+        # tasks waiting in the scheduler, and not in the redis queue, for
+        # their locks: by default, as many as the executors
+        executors = len(self.workers) * int(self.config.get('worker.threads',
+                                                            1))
+        self.max_pending = int(self.config.get('tasks.max_pending',
+                                               executors))
+        self.queue = TaskQueue.from_settings(self.redis, self.config)
+        # coalescable tasks scheduled but not started yet:
+        # uuid => (family key, instance id)
+        self.parked = {}
+        self.feeder = TaskFeeder(self.context, self.queue)
+        self.archiver = TaskArchiver(self.config, self.redis)
+        self.timer = TaskTimer(self.config, self.redis, self.queue)
 
-        self.redis = redis.StrictRedis(**redis_opts)
+    def create_tables(self):
+        # create tables only once, before forking workers; connections
+        # are not pooled, so that no connection is shared with them
+        engine = engine_from_config(dict(self.config,
+                                         **{'sqlalchemy.poolclass': NullPool}),
+                                    'sqlalchemy.')
+        Base.metadata.create_all(engine)
+        self.Session = sessionmaker(bind=engine)
+
+    def start_status_forwarder(self):
+        """ workers publish their logs on 'zmq.workers_pub_addr', forward
+            them to subscribers of 'zmq.status_pub_addr' """
+        workers_pub_addr = self.config.get('zmq.workers_pub_addr',
+                                           'tcp://127.0.0.1:8995')
+        self.log.info("Starting zmq FORWARDER (%s ==> |FORWARDER| ==> %s)",
+                      workers_pub_addr, self.config['zmq.status_pub_addr'])
+        self.forwarder = ThreadDevice(zmq.FORWARDER, zmq.SUB, zmq.PUB)
+        self.forwarder.bind_in(workers_pub_addr)
+        self.forwarder.setsockopt_in(zmq.SUBSCRIBE, "")
+        self.forwarder.bind_out(self.config['zmq.status_pub_addr'])
+        self.forwarder.start()
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    def check_workers(self, idle_workers, assigned):
+        """ starts a new worker for every worker that died, failing the
+            tasks its executors were running. Executors' addresses start
+            with the name of their worker """
+        for index, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+
+            self.log.error("Worker %s died (exit code %s), restarting it",
+                           worker.name, worker.exitcode)
+            prefix = "{}-".format(worker.name)
+            for address in [a for a in idle_workers if a.startswith(prefix)]:
+                idle_workers.remove(address)
+            for address in [a for a in assigned if a.startswith(prefix)]:
+                uuid = assigned.pop(address)
+                self.log.error("Task %s failed: worker %s died", uuid,
+                               worker.name)
+                try:
+                    Task.fail(uuid, 'Worker died', redis_client=self.redis)
+                except Exception:
+                    self.log.exception("Cannot mark task %s as failed", uuid)
+                self.notify_finished(uuid)
+                self.task_done(uuid)
+
+            self.workers[index] = AybuManagerDaemonWorker(self.config,
+                                                          index=index)
+            self.workers[index].start()
+
+    def worker_alive(self, address):
+        """ whether the process of the executor at address is alive:
+            addresses end with its pid """
+        pid = int(address.rsplit('-', 1)[1])
+        return any(worker.pid == pid and worker.is_alive()
+                   for worker in self.workers)
+
+    def task_done(self, uuid):
+        self.scheduler.done(uuid)
+        self.queue.ack(uuid)
+        for coalesced in self.queue.complete_coalesced(uuid):
+            self.notify_finished(coalesced)
 
     def start(self):
         self.log.info("Starting daemon")
+        self.create_tables()
+        self.start_status_forwarder()
 
         self.client_socket = self.context.socket(zmq.REP)
-        self.worker_socket = self.context.socket(zmq.PUB)
+        self.worker_socket = self.context.socket(zmq.ROUTER)
         self.worker_socket.setsockopt(zmq.LINGER, 0)
+        self.feeder_socket = self.context.socket(zmq.PAIR)
+        self.pub_socket = self.context.socket(zmq.PUB)
+        self.pub_socket.connect(self.config.get('zmq.workers_pub_addr',
+                                                'tcp://127.0.0.1:8995'))
         self.client_socket.bind(self.config['zmq.daemon_addr'])
-        self.worker_socket.bind('inproc://tasks')
+        self.worker_socket.bind(self.config.get('zmq.workers_addr',
+                                                'tcp://127.0.0.1:8996'))
+        self.feeder_socket.bind(FEEDER_ADDR)
 
-        self.log.debug("Starting worker")
-        self.worker.start()
+        requeued = self.queue.requeue()
+        if requeued:
+            self.log.info("Requeued %d orphaned or deferred tasks: %s",
+                          len(requeued), ", ".join(requeued))
+
+        self.log.debug("Starting %d workers", len(self.workers))
+        for worker in self.workers:
+            worker.start()
+        self.feeder.start()
+        if self.archiver.enabled:
+            self.archiver.start()
+        self.timer.start()
 
         self.log.info("Listening on %s", self.config['zmq.daemon_addr'])
 
+        poller = zmq.Poller()
+        poller.register(self.client_socket, zmq.POLLIN)
+        poller.register(self.worker_socket, zmq.POLLIN)
+        poller.register(self.feeder_socket, zmq.POLLIN)
+        # addresses of idle executors
+        idle_workers = collections.deque()
+        # address of busy executors => uuid of their task
+        assigned = {}
+        # whether a task has been asked to the feeder
+        feeding = False
+
         while True:
-            try:
-                message = self.client_socket.recv()
-                self.worker_socket.send(message)
-                task = Task(uuid=message, redis_client=self.redis,
-                            queued=datetime.datetime.now())
-                task.status = taskstatus.QUEUED
-
-            except Exception as e:
-                self.log.exception(e)
-                success = False
-                response = str(e)
-
-            else:
-                success = True
-                response = 'Task enqueued'
+            # wake up every second to look for dead workers
+            socks = dict(poller.poll(1000))
+            self.check_workers(idle_workers, assigned)
 
-                try:
-                    self.client_socket.send_json(dict(success=success,
-                                                      message=response))
-                except:
-                    self.log.exception("Error sending reply")
+            if socks.get(self.worker_socket) == zmq.POLLIN:
+                address, empty, message = self.worker_socket.recv_multipart()
+                if not self.worker_alive(address):
+                    # sent before dying: its task is released by
+                    # check_workers()
+                    self.log.warning("Ignoring %s from dead executor %s",
+                                     message, address)
+
+                else:
+                    if message != WORKER_READY:
+                        self.log.debug("Task %s done", message)
+                        assigned.pop(address, None)
+                        self.task_done(message)
+                    idle_workers.append(address)
+
+            if socks.get(self.feeder_socket) == zmq.POLLIN:
+                feeding = False
+                self.schedule_task(self.feeder_socket.recv())
+
+            if socks.get(self.client_socket) == zmq.POLLIN:
+                self.receive_task()
+
+            while idle_workers:
+                uuid = self.scheduler.pop_ready()
+                if uuid is None:
+                    break
+                self.parked.pop(uuid, None)
+                address = idle_workers.popleft()
+                assigned[address] = uuid
+                self.worker_socket.send_multipart([address, "", uuid])
+
+            # take tasks from the queue only when they can be executed:
+            # the others wait in the queue lanes, in priority order
+            if idle_workers and not feeding and \
+               not self.scheduler.blocked and \
+               len(self.scheduler) < self.max_pending:
+                self.feeder_socket.send(FEEDER_WANT)
+                feeding = True
 
         # we never get here...
+        self.feeder_socket.close()
+        self.pub_socket.close()
         self.worker_socket.close()
         self.client_socket.close()
         self.context.term()
+
+    def schedule_task(self, uuid):
+        try:
+            task = Task(uuid=uuid, redis_client=self.redis, snapshot=True)
+            if self.coalesce(task):
+                return
+
+            self.resolve_instances(task)
+
+            self.scheduler.submit(task.uuid,
+                                  task_keys(task.command, task.command_args))
+
+        except Exception:
+            self.log.exception("Cannot schedule task %s", uuid)
+            self.queue.ack(uuid)
+
+    def resolve_instances(self, task):
+        """ read only commands take shared locks on the instances they
+            work on: store the ids of those matching their filters in the
+            task, which will work on them only """
+        if task.command not in READ_ONLY_COMMANDS or \
+           'ids' in task.command_args:
+            return
+
+        args = task.command_args
+        session = self.Session()
+        try:
+            instances = Instance.matching(session, args.get('environment'),
+                                          args.get('domains'),
+                                          args.get('enabled'))
+            task['_arg.ids'] = " ".join(str(i.id) for i in instances)
+
+        finally:
+            session.close()
+
+    def coalesce(self, task):
+        """ Merge the task into a scheduled one that covers it, or merge
+            into it the waiting tasks it covers. Tasks are merged only
+            when that does not move them ahead of conflicting tasks
+            submitted before them, and they complete, with the same status
+            and result, when the task they have been merged into does.
+            Returns True if the task has been merged and must not be
+            executed.
+        """
+        if task.command not in self.queue.coalesce_commands:
+            return False
+
+        family_key = self.queue.family_key(task)
+        task_id = task.command_args.get('id', '')
+        keys = task_keys(task.command, task.command_args)
+        for uuid, (parked_family_key, parked_id) in self.parked.iteritems():
+            if parked_family_key == family_key and \
+               parked_id in (task_id, 'all') and \
+               not self.scheduler.conflicts_after(uuid, keys):
+                self.log.info("Task %s coalesced into %s", task.uuid, uuid)
+                self.redis.hdel(family_key, task.uuid)
+                self.queue.mark_coalesced(task.uuid, uuid)
+                self.queue.ack(task.uuid)
+                return True
+
+        for uuid in self.queue.coalesce(task, task_keys, keys_conflict):
+            self.log.info("Task %s coalesced into %s", uuid, task.uuid)
+
+        self.parked[task.uuid] = (family_key, task_id)
+        return False
+
+    def notify_finished(self, uuid):
+        self.pub_socket.send_multipart(["{}.finished".format(uuid),
+                                        "task endend"])
+
+    def receive_task(self):
+        """ tasks submitted through the zmq socket are pushed on the
+            redis queue too """
+        try:
+            message = self.client_socket.recv()
+            task = Task(uuid=message, redis_client=self.redis, snapshot=True)
+            if task.status in (taskstatus.UNDEF, taskstatus.DEFERRED):
+                self.queue.push(task)
+
+        except Exception as e:
+            self.log.exception(e)
+            success = False
+            response = str(e)
+
+        else:
+            success = True
+            response = 'Task enqueued'
+
+        try:
+            self.client_socket.send_json(dict(success=success,
+                                              message=response))
+        except:
+            self.log.exception("Error sending reply")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from sqlalchemy.orm import sessionmaker
+from aybu.manager.activity_log import ActivityLog
+from aybu.manager.activity_log.process import (check_limits,
+                                               get_limits,
+                                               set_limits)
+from aybu.manager.models import (Environment,
+                                 Instance)
+
+
+__all__ = ['fan_out', 'FanOutResult']
+FanOutResult = collections.namedtuple('FanOutResult', ['domain', 'success',
+                                                       'error'])
+log = logging.getLogger(__name__)
+
+
+def fan_out(session, task, instances, function, concurrency=None):
+    """ Calls function(session, instance) for every instance on a pool of
+        at most 'concurrency' threads ('tasks.fanout.concurrency' setting
+        if not given).
+        Every call gets its own session and activity log and is committed
+        on its own, so a failing instance does not affect the others.
+        The outcome for every instance is stored in the task as
+        'fanout.$domain', and the progress is reported as instances
+        complete. Returns the list of FanOutResult.
+        Once the task times out or is cancelled the instances not yet
+        started are failed, and the error is raised when all the running
+        calls have completed.
+    """
+    if concurrency is None:
+        concurrency = int(Environment.settings.get('tasks.fanout.concurrency',
+                                                   4))
+
+    targets = [(instance.id, instance.domain) for instance in instances]
+    if not targets:
+        return []
+
+    Session = sessionmaker(bind=session.bind)
+    parent_name = threading.current_thread().name
+    timings_lock = threading.Lock()
+    limits = get_limits()
+
+    def initializer():
+        # named after the executor, whose log handler accepts records
+        # coming from its helper threads
+        current = threading.current_thread()
+        current.name = "{}-fanout-{}".format(parent_name, current.ident)
+        set_limits(*limits)
+
+    def run(target):
+        id_, domain = target
+        instance_session = Session()
+        ActivityLog.attach_to(instance_session)
+        try:
+            check_limits()
+            function(instance_session, Instance.get(instance_session, id_))
+            instance_session.commit()
+
+        except Exception as e:
+            log.exception("Error on %s", domain)
+            try:
+                instance_session.rollback()
+            except Exception:
+                log.exception("Error in rollback for %s", domain)
+            return FanOutResult(domain=domain, success=False, error=str(e))
+
+        else:
+            return FanOutResult(domain=domain, success=True, error='')
+
+        finally:
+            # account the time spent in actions to the task
+            if hasattr(session, 'activity_log'):
+                with timings_lock:
+                    for kind, seconds in \
+                            instance_session.activity_log.timings.iteritems():
+                        session.activity_log.timings[kind] += seconds
+            instance_session.close()
+
+    pool = ThreadPool(min(concurrency, len(targets)), initializer=initializer)
+    results = []
+    task.progress(0, len(targets), task.command_name)
+    try:
+        for result in pool.imap_unordered(run, targets):
+            results.append(result)
+            task.progress(len(results), len(targets), task.command_name)
+
+    finally:
+        pool.close()
+        pool.join()
+
+    for result in results:
+        task['fanout.{}'.format(result.domain)] = \
+                'OK' if result.success else 'FAILED: {}'.format(result.error)
+
+    failed = [r.domain for r in results if not r.success]
+    if failed:
+        log.error("%d of %d instances failed: %s", len(failed), len(results),
+                  ", ".join(failed))
+
+    check_limits()
+    return results
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import redis
+import threading
+import time
+import zmq
+
+
+FEEDER_ADDR = 'inproc://feeder'
+FEEDER_WANT = 'WANT'
+
+
+class TaskFeeder(threading.Thread):
+    """ Pops tasks from the redis queue on behalf of the daemon.
+        The daemon sends a WANT message on a PAIR socket whenever it can
+        accept a new task: the feeder blocks on the queue and replies with
+        the uuid of the popped task. Tasks are left in the queue while the
+        daemon has no room for them.
+    """
+
+    def __init__(self, context, queue, timeout=1):
+        super(TaskFeeder, self).__init__(name='feeder')
+        self.log = logging.getLogger(__name__)
+        self.context = context
+        self.queue = queue
+        self.timeout = timeout
+        self.daemon = True
+
+    def run(self):
+        socket = self.context.socket(zmq.PAIR)
+        socket.connect(FEEDER_ADDR)
+
+        while True:
+            socket.recv()
+            uuid = None
+            while uuid is None:
+                try:
+                    uuid = self.queue.pop(timeout=self.timeout)
+
+                except redis.ConnectionError:
+                    self.log.exception("Error popping tasks from redis")
+                    time.sleep(self.timeout)
+
+            self.log.debug("Popped task %s", uuid)
+            socket.send(uuid)
+
+        socket.close()
@@ -17,11 +17,20 @@ limitations under the License.
 """
 
 import logging
+import threading
 from zmq.log.handlers import (TOPIC_DELIM,
                               PUBHandler)
 
 
 class RedisPUBHandler(PUBHandler):
+    """ Publishes records on a zmq socket and stores them in the task logs.
+        When 'worker.log_buffer.records' is set, records are written to
+        redis by a flusher thread, in a single pipeline, every that many
+        records or every 'worker.log_buffer.interval' milliseconds, and
+        when the handler is closed at the end of the task. At most
+        'worker.log_buffer.max' records are kept waiting: further records
+        are dropped and counted, so a slow redis does not stall the task.
+    """
 
     def __init__(self, config, socket, context, level=logging.NOTSET):
         self.context = context
@@ -31,10 +40,88 @@ class RedisPUBHandler(PUBHandler):
         super(RedisPUBHandler, self).__init__(socket, context)
         self.setLevel(level)
         self.task = None
+        self.thread_name = None
+        self.buffer_records = int(config.get('worker.log_buffer.records', 0))
+        self.buffer_interval = \
+                int(config.get('worker.log_buffer.interval', 200)) / 1000.0
+        self.buffer_max = int(config.get('worker.log_buffer.max', 5000))
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.dropped = 0
+        self.flusher = None
+        self.flush_needed = threading.Event()
+        self.stopping = threading.Event()
 
     def set_task(self, task):
         self.task = task
         self.root_topic = task.uuid
+        # executors run tasks concurrently: only handle records emitted
+        # by the thread that runs the task or by its helper threads,
+        # named "$executor-..."
+        self.thread_name = threading.current_thread().name
+        if self.buffer_records > 0:
+            # not named after the executor, so that records about redis
+            # errors emitted by the flusher are not handled
+            self.flusher = threading.Thread(
+                        target=self.run_flusher,
+                        name="logflush-{}".format(self.thread_name))
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def run_flusher(self):
+        while not self.stopping.is_set():
+            self.flush_needed.wait(self.buffer_interval)
+            self.flush_needed.clear()
+            self.flush()
+
+    def flush(self):
+        """ write the buffered records to redis """
+        with self.buffer_lock:
+            entries, self.buffer = self.buffer, []
+
+        if not entries or not self.task:
+            return
+
+        try:
+            self.task.log_many(entries, self.ttl)
+
+        except Exception:
+            with self.buffer_lock:
+                self.dropped += len(entries)
+
+    def close(self):
+        """ flush the records left and record how many were dropped """
+        if self.flusher is not None:
+            self.stopping.set()
+            self.flush_needed.set()
+            self.flusher.join()
+            self.flusher = None
+
+        self.flush()
+        if self.dropped and self.task:
+            try:
+                self.task['log_dropped'] = self.dropped
+                self.task.log("{} log records dropped".format(self.dropped),
+                              'WARNING', self.ttl)
+            except Exception:
+                pass
+
+        super(RedisPUBHandler, self).close()
+
+    def filter(self, record):
+        if self.thread_name is not None and \
+           record.threadName != self.thread_name and \
+           not record.threadName.startswith("{}-".format(self.thread_name)):
+            return False
+        return super(RedisPUBHandler, self).filter(record)
+
+    def publish(self, topic, message):
+        """ send a message on the socket used for records """
+        self.acquire()
+        try:
+            self.socket.send_multipart([topic, message])
+        finally:
+            self.release()
 
     def emit(self, record):
         """Emit a log message on my socket."""
@@ -67,6 +154,21 @@ class RedisPUBHandler(PUBHandler):
 
         # map str, since sometimes we get unicode, and zmq can't deal with it
         self.socket.send_multipart([topic, msg])
-        if self.task:
+        if not self.task:
+            return
+
+        if self.flusher is None:
             self.task.log(msg, record.levelname, self.ttl,
                           levelno=record.levelno)
+            return
+
+        with self.buffer_lock:
+            if len(self.buffer) >= self.buffer_max:
+                self.dropped += 1
+                return
+
+            self.buffer.append((msg, record.levelno))
+            full = len(self.buffer) >= self.buffer_records
+
+        if full:
+            self.flush_needed.set()
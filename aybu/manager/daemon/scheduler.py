@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import logging
+
+
+__all__ = ['TaskScheduler', 'task_keys', 'keys_conflict', 'EXCLUSIVE',
+           'READ_ONLY_COMMANDS', 'SHARED']
+
+# lock key of the tasks that must run alone (fleet-wide and environment
+# commands, or commands whose resources cannot be derived from arguments)
+EXCLUSIVE = '*'
+
+# commands only reading the instances whose ids are listed in their 'ids'
+# argument: they take shared locks on them, so that long fleet-wide runs
+# exclude only the tasks changing those instances
+READ_ONLY_COMMANDS = frozenset(['instance.backup'])
+# suffix of shared lock keys
+SHARED = ':shared'
+
+# command argument => kind of the resource it identifies
+KEYED_ARGS = (
+    ('id', 'instance'),
+    ('instance_id', 'instance'),
+    # instance serving the alias or redirect a task works on
+    ('owner_id', 'instance'),
+    ('domain', 'domain'),
+    ('new_domain', 'domain'),
+    ('source', 'domain'),
+    ('new_source', 'domain'),
+)
+
+
+def task_keys(command, args):
+    """ Returns the frozenset of resources a command works on, or EXCLUSIVE
+        if the command may touch any resource.
+    """
+    if command in READ_ONLY_COMMANDS:
+        if 'ids' not in args:
+            return EXCLUSIVE
+        return frozenset("instance:{}{}".format(id_, SHARED)
+                         for id_ in args['ids'].split())
+
+    module = command.split('.')[0]
+    if module == 'environment' or args.get('id') == 'all':
+        return EXCLUSIVE
+
+    keys = set()
+    for arg, kind in KEYED_ARGS:
+        value = args.get(arg)
+        if value:
+            keys.add("{}:{}".format(kind, value))
+
+    if not keys:
+        return EXCLUSIVE
+
+    return frozenset(keys)
+
+
+def _resource(key):
+    return key[:-len(SHARED)] if key.endswith(SHARED) else key
+
+
+def keys_conflict(keys, other):
+    """ whether tasks with the given lock keys cannot run concurrently,
+        nor be reordered: a resource can be locked by many tasks only if
+        they all hold shared keys on it """
+    if keys == EXCLUSIVE or other == EXCLUSIVE:
+        return True
+
+    exclusive = set(k for k in keys if not k.endswith(SHARED))
+    other_exclusive = set(k for k in other if not k.endswith(SHARED))
+    return bool(exclusive & set(_resource(k) for k in other) or
+                other_exclusive & set(_resource(k) for k in keys))
+
+
+class TaskScheduler(object):
+    """ Keeps tasks waiting for execution and hands out only those whose
+        lock keys do not overlap with running tasks.
+        Tasks sharing a key run in submission order; an EXCLUSIVE task runs
+        alone and tasks submitted after it wait for its completion.
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger("{}.TaskScheduler".format(__name__))
+        self.pending = collections.deque()
+        self.running = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    @property
+    def running_exclusive(self):
+        return EXCLUSIVE in self.running.values()
+
+    @property
+    def blocked(self):
+        """ whether tasks submitted now would wait for an EXCLUSIVE task,
+            running or pending """
+        return self.running_exclusive or \
+               any(keys == EXCLUSIVE for uuid, keys in self.pending)
+
+    def submit(self, uuid, keys):
+        self.log.debug("Scheduling %s (keys: %s)", uuid, keys)
+        self.pending.append((uuid, keys))
+
+    def conflicts_after(self, uuid, keys):
+        """ whether any task submitted after the pending task uuid has lock
+            keys conflicting with the given ones: a task with those keys
+            cannot be moved ahead of them """
+        following = False
+        for pending, pending_keys in self.pending:
+            if following and keys_conflict(keys, pending_keys):
+                return True
+            following = following or pending == uuid
+        return False
+
+    def pop_ready(self):
+        """ Returns the uuid of the first task that can be started now,
+            marking it as running, or None """
+        if self.running_exclusive:
+            return None
+
+        # keys of the running tasks, and of the pending ones that
+        # later tasks cannot overtake
+        claimed = self.running.values()
+        for position, (uuid, keys) in enumerate(self.pending):
+            if keys == EXCLUSIVE:
+                if self.running or position > 0:
+                    return None
+                break
+
+            if not any(keys_conflict(keys, other) for other in claimed):
+                break
+
+            claimed.append(keys)
+
+        else:
+            return None
+
+        del self.pending[position]
+        self.running[uuid] = keys
+        return uuid
+
+    def done(self, uuid):
+        if self.running.pop(uuid, None) is None:
+            self.log.warning("Task %s was not running", uuid)
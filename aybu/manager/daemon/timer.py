@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import threading
+import time
+from aybu.manager.task import TaskSchedule
+
+
+class TaskTimer(threading.Thread):
+    """ Pushes scheduled tasks on the queue as they become due, checking
+        every 'tasks.schedule.interval' seconds, 'tasks.schedule.batch'
+        schedules at time.
+    """
+
+    def __init__(self, config, redis_client, queue):
+        super(TaskTimer, self).__init__(name='timer')
+        self.log = logging.getLogger(__name__)
+        self.queue = queue
+        self.schedule = TaskSchedule(redis_client)
+        self.interval = float(config.get('tasks.schedule.interval', 1))
+        self.batch = int(config.get('tasks.schedule.batch', 100))
+        self.daemon = True
+
+    def run(self):
+        while True:
+            try:
+                while self.promote() == self.batch:
+                    pass
+
+            except Exception:
+                self.log.exception("Error promoting scheduled tasks")
+
+            time.sleep(self.interval)
+
+    def promote(self):
+        """ queue the due tasks of a batch of schedules.
+            Returns the number of schedules processed """
+        ids = self.schedule.due(self.batch)
+        for id_ in ids:
+            uuid = self.schedule.promote(id_, self.queue, retry=self.interval)
+            if uuid:
+                self.log.info("Queued task %s of schedule %s", uuid, id_)
+        return len(ids)
@@ -22,103 +22,230 @@ from sqlalchemy.orm import (sessionmaker,
 from sqlalchemy.pool import NullPool
 from aybu.manager.models import Base, Environment
 from aybu.manager.activity_log import ActivityLog
-from aybu.manager.task import Task, taskstatus
+from aybu.manager.activity_log.process import (clear_limits,
+                                               set_limits)
+from aybu.manager.exc import (ParamsError,
+                              TaskCancelledError,
+                              TaskTimeoutError)
+from aybu.manager.task import (Task,
+                              TaskStats,
+                              taskstatus,
+                              redis_client_from_settings)
+from . commands import load_commands
 from . handlers import RedisPUBHandler
 import datetime
 import logging
-import redis
+import multiprocessing
+import os
 import threading
+import time
 import zmq
 
 
-class AybuManagerDaemonWorker(threading.Thread):
+WORKER_READY = "READY"
 
-    def __init__(self, context, config):
-        super(AybuManagerDaemonWorker, self).__init__(name='worker')
-        self.config = config
+
+class AybuManagerDaemonWorker(multiprocessing.Process):
+    """ A worker process. Every worker owns its zmq context, its SQLAlchemy
+        engine and its redis client, all created after the fork in run().
+        Tasks are executed by 'worker.threads' executor threads: each one
+        asks the daemon for tasks on a REQ socket connected to
+        'zmq.workers_addr': the first request is a READY message, then the
+        uuid of every completed task is sent back to get the next one.
+        Executors are named after their worker, and so are their sockets:
+        if an executor dies the worker exits, and the daemon fails the
+        tasks of its executors and starts a new worker.
+    """
+
+    def __init__(self, config, index=0):
+        super(AybuManagerDaemonWorker, self).__init__(
+                                            name='worker-{}'.format(index))
+        self.config = dict(config)
+        self.daemon = True
+
+    def setup(self):
         self.log = logging.getLogger(__name__)
-        self.context = context
+        self.context = zmq.Context()
         self.config["sqlalchemy.poolclass"] = NullPool
         self.engine = engine_from_config(self.config, 'sqlalchemy.')
         self.Session = scoped_session(sessionmaker(bind=self.engine))
         Base.metadata.bind = self.engine
-        Base.metadata.create_all()
-        redis_opts = {k.replace('redis.', ''): self.config[k]
-                      for k in self.config
-                      if k.startswith('redis.')}
-        if 'port' in redis_opts:
-            redis_opts['port'] = int(redis_opts['port'])
-
-        self.redis = redis.StrictRedis(**redis_opts)
-        self.pub_socket = self.context.socket(zmq.PUB)
-        self.pub_socket.bind(self.config['zmq.status_pub_addr'])
+        self.redis = redis_client_from_settings(self.config)
         Environment.initialize(self.config, section=None)
+        Task.configure(self.config)
+        self.stats = TaskStats(self.redis)
+        # the level of the logs of every task is set on its handler, as
+        # executors share the logger
+        logging.getLogger('aybu').setLevel(logging.DEBUG)
+        # import all the commands before serving any task
+        self.commands = load_commands()
+        self.log.debug("Worker %s loaded %d commands", self.name,
+                       len(self.commands))
+
+    def timeout_for(self, task):
+        """ seconds the task can run for, from 'tasks.timeout.$command',
+            'tasks.timeout.$module' or 'tasks.timeout'; 0 means no limit """
+        for key in ('tasks.timeout.{}'.format(task.command),
+                    'tasks.timeout.{}'.format(task.command_module),
+                    'tasks.timeout'):
+            if key in self.config:
+                return float(self.config[key])
+        return 0
 
     def run(self):
 
-        self.log.debug("Worker starting ... ")
-        self.socket = self.context.socket(zmq.SUB)
-        self.socket.setsockopt(zmq.SUBSCRIBE, "")  # subscribe to all
-        self.socket.connect('inproc://tasks')
-        log = logging.getLogger('aybu')
+        self.setup()
+        threads = int(self.config.get('worker.threads', 1))
+        self.log.debug("Worker %s starting %d executors", self.name, threads)
+        executors = [threading.Thread(target=self.serve,
+                                      name='{}-executor-{}'.format(self.name,
+                                                                   i))
+                     for i in xrange(threads)]
+        for executor in executors:
+            executor.daemon = True
+            executor.start()
+
+        while all(executor.is_alive() for executor in executors):
+            time.sleep(1)
+
+        self.log.critical("An executor of worker %s died, exiting", self.name)
+
+    def serve(self):
+        """ Executor thread main loop. Every executor has its own sockets,
+            as zmq sockets cannot be shared between threads. """
+        socket = self.context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.IDENTITY, "{}-{}".format(
+                                            threading.current_thread().name,
+                                            os.getpid()))
+        socket.connect(self.config.get('zmq.workers_addr',
+                                       'tcp://127.0.0.1:8996'))
+        pub_socket = self.context.socket(zmq.PUB)
+        pub_socket.connect(self.config.get('zmq.workers_pub_addr',
+                                           'tcp://127.0.0.1:8995'))
+        socket.send(WORKER_READY)
 
         while True:
-            task = Task(uuid=self.socket.recv(),
-                        redis_client=self.redis,
-                        started=datetime.datetime.now())
-            session = self.Session()
-            if not hasattr(session, 'activity_log'):
-                ActivityLog.attach_to(session)
-
-            level = int(task.get('log_level', logging.DEBUG))
-            handler = RedisPUBHandler(self.config, self.pub_socket,
-                                      self.context, level=level)
-            handler.set_task(task)
-            log.addHandler(handler)
-            log.setLevel(level)
-            result = None
-
+            uuid = socket.recv()
             try:
-                module_name = 'aybu.manager.daemon.commands.{}'\
-                        .format(task.command_module)
-                module = __import__(module_name,
-                                    fromlist=[task.command_name])
-                function = getattr(module, task.command_name)
-                log.debug('Task received: %s: %s', task, task.command_args)
-                result = function(session, task, **task.command_args)
-                session.commit()
+                self.execute(uuid, pub_socket)
+
+            except Exception:
+                # i.e. redis errors while updating the task: the daemon
+                # must be told anyway, to release its locks
+                self.log.exception("Error executing task %s", uuid)
+                self.fail(uuid, pub_socket)
 
-            except ImportError:
-                session.rollback()
-                task.status = taskstatus.FAILED
-                task.result = "Cannot find resource {}"\
-                        .format(task.command_module)
-                log.exception(task.result)
+            socket.send(uuid)
 
-            except AttributeError:
-                session.rollback()
-                task.status = taskstatus.FAILED
-                task.result = "Cannot find action {} on {}"\
-                        .format(task.command_name, task.command_module)
-                log.critical(task.result)
+        pub_socket.close()
+        socket.close()
 
-            except Exception:
-                session.rollback()
-                log.exception('Error while executing task')
-                task.status = taskstatus.FAILED
-                task.result = str('Error')
+    def fail(self, uuid, pub_socket):
+        """ marks as FAILED a task whose execution did not complete """
+        try:
+            Task.fail(uuid, 'Error', redis_client=self.redis)
 
-            else:
-                task.status = taskstatus.FINISHED
-                log.info("Task completed successfully")
+        except Exception:
+            self.log.exception("Cannot mark task %s as failed", uuid)
 
+        pub_socket.send_multipart(["{}.finished".format(uuid),
+                                   "task endend"])
+
+    def execute(self, uuid, pub_socket):
+        log = logging.getLogger('aybu')
+        started = datetime.datetime.now()
+        task = Task(uuid=uuid,
+                    redis_client=self.redis,
+                    snapshot=True,
+                    status=taskstatus.STARTED,
+                    started=started)
+        session = self.Session()
+        if not hasattr(session, 'activity_log'):
+            ActivityLog.attach_to(session)
+        session.activity_log.timings.clear()
+        # seconds spent in every phase of the task
+        timings = {}
+        queued = Task.parse_datetime(task.get('queued'))
+        if queued:
+            timings['queue_wait'] = (started - queued).total_seconds()
+
+        level = int(task.get('log_level', logging.DEBUG))
+        handler = RedisPUBHandler(self.config, pub_socket,
+                                  self.context, level=level)
+        handler.set_task(task)
+        task.publisher = handler.publish
+        log.addHandler(handler)
+        result = None
+
+        try:
+            command = self.commands.get(task.command)
+            if command is None:
+                raise ParamsError("Unknown command {}".format(task.command))
+            command.check_args(task.command_args)
+            log.debug('Task received: %s: %s', task, task.command_args)
+            if 'cancel' in task:
+                raise TaskCancelledError("Task cancelled before starting")
+
+            timeout = self.timeout_for(task)
+            start = time.time()
+            set_limits(deadline=start + timeout if timeout else None,
+                       cancelled=task.cancel_requested)
+            try:
+                result = command(session, task, **task.command_args)
             finally:
-                task['finished'] = datetime.datetime.now()
-                task.result = result or ''
-                self.pub_socket.send_multipart(["{}.finished".format(task.uuid),
-                                                "task endend"])
-                session.close()
-                log.removeHandler(handler)
-                del handler
-
-        self.socket.close()
+                clear_limits()
+                timings['execution'] = time.time() - start
+
+            start = time.time()
+            try:
+                session.commit()
+            finally:
+                timings['commit'] = time.time() - start
+
+        except ParamsError as e:
+            session.rollback()
+            task.status = taskstatus.FAILED
+            result = str(e)
+            log.critical(result)
+
+        except TaskCancelledError as e:
+            session.rollback()
+            task.status = taskstatus.CANCELLED
+            result = str(e)
+            log.warning(result)
+
+        except TaskTimeoutError as e:
+            session.rollback()
+            task.status = taskstatus.FAILED
+            result = "{} after {} seconds".format(e, timeout)
+            log.error(result)
+
+        except Exception:
+            session.rollback()
+            log.exception('Error while executing task')
+            task.status = taskstatus.FAILED
+            task.result = str('Error')
+
+        else:
+            task.status = taskstatus.FINISHED
+            log.info("Task completed successfully")
+
+        finally:
+            for kind, seconds in session.activity_log.timings.iteritems():
+                timings['action.{}'.format(kind)] = seconds
+            values = {'timing.{}'.format(phase): "{:.3f}".format(seconds)
+                      for phase, seconds in timings.iteritems()}
+            task.update(values, finished=datetime.datetime.now(),
+                        result=result or '')
+            try:
+                self.stats.record(task.command, timings)
+            except Exception:
+                log.exception("Cannot record timings")
+            # store all the logs before notifying the end of the task
+            log.removeHandler(handler)
+            handler.close()
+            pub_socket.send_multipart(["{}.finished".format(task.uuid),
+                                       "task endend"])
+            session.close()
+            del handler
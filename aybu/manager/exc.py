@@ -46,3 +46,11 @@ class ParamsError(RestError):
 
 class TaskNotFoundError(RestError):
     pass
+
+
+class TaskTimeoutError(OperationalError):
+    pass
+
+
+class TaskCancelledError(OperationalError):
+    pass
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import logging
+import threading
+import alembic.config
+from alembic.environment import EnvironmentContext
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import create_engine
+from aybu.manager.models.instance import alembic_lock
+
+
+__all__ = ['MigrationRunner', 'MigrationResult']
+MigrationResult = collections.namedtuple('MigrationResult',
+                                         ['domain', 'from_revision',
+                                          'to_revision', 'steps'])
+log = logging.getLogger(__name__)
+
+
+class MigrationRunner(object):
+    """ Upgrades the aybu.core schema of the instances of an environment.
+        The migration scripts are loaded once, and instances are upgraded
+        in process over a connection of their database, which is used to
+        read their current revision too: those already at the target
+        revision are skipped.
+        Revisions are read concurrently (i.e. on the fan_out threads), while
+        upgrades are serialized by alembic_lock, as alembic installs module
+        level proxies (alembic.context, alembic.op).
+        Every instance database has its own credentials, so engines are
+        pooled per database for the lifetime of the runner: close() disposes
+        them.
+    """
+
+    def __init__(self, script_location):
+        self.config = alembic.config.Config()
+        self.config.set_main_option('script_location', script_location)
+        self.script = ScriptDirectory.from_config(self.config)
+        self.engines = {}
+        self.engines_lock = threading.Lock()
+
+    def engine(self, url):
+        with self.engines_lock:
+            if url not in self.engines:
+                self.engines[url] = create_engine(url)
+            return self.engines[url]
+
+    def close(self):
+        with self.engines_lock:
+            for engine in self.engines.itervalues():
+                engine.dispose()
+            self.engines.clear()
+
+    def resolve(self, revision):
+        return self.script.get_revision(revision).revision
+
+    def steps(self, from_revision, to_revision):
+        """ the migrations going from from_revision (None for an empty
+            database) to to_revision, in the order they are applied """
+        revisions = self.script.iterate_revisions(to_revision, from_revision)
+        return [(script.module.upgrade, script.down_revision, script.revision)
+                for script in reversed(list(revisions))]
+
+    def upgrade(self, instance, revision='head'):
+        """ upgrade the database of a single instance, if it is not at the
+            given revision yet. Returns a MigrationResult, whose steps are
+            the number of applied revisions """
+        target = self.resolve(revision)
+        connection = self.engine(instance.database_config.sqlalchemy_url)\
+                         .connect()
+        try:
+            current = MigrationContext.configure(connection)\
+                                      .get_current_revision()
+            if current == target:
+                return MigrationResult(instance.domain, current, target, 0)
+
+            steps = self.steps(current, target)
+            log.info("Upgrading %s from %s to %s (%d revisions)",
+                     instance.domain, current, target, len(steps))
+            with alembic_lock:
+                with EnvironmentContext(self.config, self.script,
+                                        fn=lambda rev, context: steps,
+                                        destination_rev=target) as env:
+                    env.configure(connection=connection)
+                    with env.begin_transaction():
+                        env.run_migrations()
+
+            return MigrationResult(instance.domain, current, target,
+                                   len(steps))
+
+        finally:
+            connection.close()
@@ -24,11 +24,12 @@ from . redirect import Redirect
 from . environment import Environment
 from . user import User, Group
 from . theme import Theme
+from . task import ArchivedTask
 from . base import Base
 
 
 __all__ = ['Instance', 'Environment', 'Redirect', 'User', 'Group', 'Theme',
-           'Base', 'Alias', 'import_from_json']
+           'Base', 'Alias', 'ArchivedTask', 'import_from_json']
 
 
 def import_from_json(session, source):
@@ -19,13 +19,16 @@ limitations under the License.
 import atexit
 import collections
 import datetime
+import fnmatch
 import json
 import os
+import pipes
 import pkg_resources
 import tempfile
 import signal
 import shutil
 import tarfile
+import threading
 import uuid
 
 import alembic
@@ -65,6 +68,7 @@ from aybu.manager.activity_log.fs import (mkdir,
                                           rm,
                                           rmtree,
                                           rmdir)
+from aybu.manager.activity_log.command import command
 from aybu.manager.activity_log.packages import install, uninstall
 from aybu.manager.activity_log.database import (create_database,
                                                 drop_database,
@@ -100,6 +104,9 @@ DBConf = collections.namedtuple('DBConf', ['type', 'driver', 'user',
                                            'sqlalchemy_url'])
 Address = collections.namedtuple('Address', ['address', 'port'])
 UWSGIConf = collections.namedtuple('UWSGIConf', ['stats_server'])
+# alembic commands install module level proxies (alembic.context,
+# alembic.op), so they cannot run concurrently in the same process
+alembic_lock = threading.Lock()
 
 
 class Instance(Base):
@@ -165,6 +172,25 @@ class Instance(Base):
                    filters=(Instance.domain == domain,),
                    return_query=True).one()
 
+    @classmethod
+    def matching(cls, session, environment=None, domains=None, enabled=None):
+        """ instances of the environment named 'environment', with a domain
+            matching one of the space separated shell patterns in 'domains',
+            enabled or not ('true' or 'false'). Empty filters match all. """
+        instances = cls.all(session)
+        if environment:
+            instances = [i for i in instances
+                         if i.environment.name == environment]
+        if domains:
+            patterns = domains.split()
+            instances = [i for i in instances
+                         if any(fnmatch.fnmatch(i.domain, p)
+                                for p in patterns)]
+        if enabled not in (None, ''):
+            enabled = unicode(enabled).lower() in (u'true', u'1', u'yes')
+            instances = [i for i in instances if i.enabled == enabled]
+        return instances
+
     def to_dict(self, paths=False):
         res = super(Instance, self).to_dict()
         if paths:
@@ -664,8 +690,9 @@ class Instance(Base):
     @classmethod
     def deploy(cls, session, domain, owner, environment,
                technical_contact, theme=None, default_language=u'it',
-               database_password=None, enabled=True):
-
+               database_password=None, enabled=True, progress=None):
+        """ progress(done, total, stage) is called as deployment goes on """
+        progress = progress or (lambda done, total, stage: None)
         if not database_password:
             database_password = pwgen.pwgen(16, no_symbols=True)
 
@@ -680,10 +707,15 @@ class Instance(Base):
             session.add(instance)
             session.flush()
 
+            progress(0, 6, 'structure')
             instance._create_structure(session)
+            progress(1, 6, 'package')
             instance._create_python_package_paths(session)
+            progress(2, 6, 'database')
             instance._create_database(session)
+            progress(3, 6, 'data')
             instance._populate_database(session)
+            progress(4, 6, 'groups')
 
             # add group and users
             if instance.owner.organization:
@@ -705,9 +737,11 @@ class Instance(Base):
                                   instance.owner, instance_group)
                 instance.owner.groups.append(instance_group)
 
+            progress(5, 6, 'enable')
             instance.flush_cache()
             if enabled:
                 instance.enabled = True
+            progress(6, 6, 'done')
 
         except:
             session.rollback()
@@ -817,13 +851,23 @@ class Instance(Base):
         """ Uses alembic to migrate aybu.core schema to given revision """
         self.log.info("Upgrading schema for %s to revision '%s'", self,
                       revision)
-        alembic.command.upgrade(self.alembic, revision)
+        with alembic_lock:
+            alembic.command.upgrade(self.alembic, revision)
 
     def stamp_schema(self, revision='head'):
         self.log.info("Stamping schema as revision '%s'", revision)
-        alembic.command.stamp(self.alembic, revision)
-
-    def archive(self, archive_name=None, session=None):
+        with alembic_lock:
+            alembic.command.stamp(self.alembic, revision)
+
+    def archive(self, archive_name=None, session=None, progress=None,
+                throttle=None):
+        """ progress(done, total, stage) is called as archiving goes on.
+            If throttle is given, i.e. "ionice -c3 nice -n 10", the
+            database dump, the copy of the files and the compression are
+            all done by subprocesses run through it.
+            Returns the path of the archive.
+        """
+        progress = progress or (lambda done, total, stage: None)
         session = session or Session.object_session(self)
         if not session:
             raise DetachedInstanceError()
@@ -839,15 +883,35 @@ class Instance(Base):
         try:
             tempdir = tempfile.mkdtemp()
             filesdir = os.path.join(tempdir, "files")
+            progress(0, 3, 'dump')
             session.activity_log.add(dump_database, self.database_config,
-                                     tempdir)
+                                     tempdir, prefix=throttle)
             self.log.debug("Copying files to %s", tempdir)
-            shutil.copytree(self.paths.instance_dir, filesdir,
-                            ignore=shutil.ignore_patterns('*.pyc'))
+            progress(1, 3, 'copy')
+            if throttle:
+                cp = "{} cp -a {} {}".format(
+                                        throttle,
+                                        pipes.quote(self.paths.instance_dir),
+                                        pipes.quote(filesdir))
+                session.activity_log.add(command, cp, on_init=True)
+            else:
+                shutil.copytree(self.paths.instance_dir, filesdir,
+                                ignore=shutil.ignore_patterns('*.pyc'))
             self.log.debug('Creating archive from %s to %s',
                             tempdir, archive_path)
-            with tarfile.open(archive_path, "w:gz") as t:
-                t.add(tempdir, arcname='/')
+            progress(2, 3, 'compress')
+            if throttle:
+                session.activity_log.add(command,
+                                         "{} tar -czf {} --exclude=*.pyc "
+                                         "-C {} .".format(
+                                            throttle,
+                                            pipes.quote(archive_path),
+                                            pipes.quote(tempdir)),
+                                         on_init=True)
+            else:
+                with tarfile.open(archive_path, "w:gz") as t:
+                    t.add(tempdir, arcname='/')
+            progress(3, 3, 'done')
 
         except:
             if os.path.isfile(archive_path):
@@ -857,6 +921,8 @@ class Instance(Base):
         finally:
             shutil.rmtree(tempdir)
 
+        return archive_path
+
     def restore(self, archive_name, session=None):
         session = session or Session.object_session(self)
         if not session:
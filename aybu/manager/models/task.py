@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import logging
+from sqlalchemy import (Column,
+                        DateTime,
+                        Unicode,
+                        UnicodeText)
+
+from . base import Base
+
+
+__all__ = ['ArchivedTask']
+
+
+class ArchivedTask(Base):
+    """ A task moved out of redis once past its retention time.
+        'fields' stores the whole task hash (as JSON), 'logs' the last
+        log entries, as a JSON list of [levelno, message] pairs.
+    """
+
+    __tablename__ = u'tasks_archive'
+    __table_args__ = ({'mysql_engine': 'InnoDB'})
+
+    uuid = Column(Unicode(32), primary_key=True)
+    command = Column(Unicode(128), nullable=False, index=True)
+    status = Column(Unicode(16), nullable=False, index=True)
+    requested = Column(DateTime, index=True)
+    started = Column(DateTime)
+    finished = Column(DateTime, index=True)
+    fields = Column(UnicodeText, nullable=False, default=u'{}')
+    logs = Column(UnicodeText, nullable=False, default=u'[]')
+
+    def to_dict(self):
+        res = json.loads(self.fields)
+        res['archived'] = True
+        return res
+
+    def get_logs(self, level):
+        """ same as aybu.manager.task.Task.get_logs """
+        if not isinstance(level, int):
+            level = getattr(logging, level)
+        return [msg for levelno, msg in json.loads(self.logs)
+                if levelno >= level]
+
+    @classmethod
+    def with_status(cls, session, status):
+        return cls.search(session, filters=(cls.status == status,),
+                          return_query=True).all()
+
+    @classmethod
+    def page(cls, session, limit, before=None):
+        """ the last 'limit' tasks requested before 'before' (a datetime) """
+        query = session.query(cls).filter(cls.requested != None)
+        if before is not None:
+            query = query.filter(cls.requested < before)
+        return query.order_by(cls.requested.desc()).limit(limit).all()
+
+    def __repr__(self):
+        return "<ArchivedTask uuid='{}' status='{}'>".format(self.uuid,
+                                                            self.status)
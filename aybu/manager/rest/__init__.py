@@ -22,7 +22,9 @@ from pyramid.config import Configurator
 from sqlalchemy import engine_from_config
 from zmq.devices.basedevice import ThreadDevice
 
+from aybu.manager.daemon.commands import get_commands
 from aybu.manager.models import Base, Environment
+from aybu.manager.task import Task
 from . authentication import AuthenticationPolicy
 from . request import Request
 
@@ -39,6 +41,13 @@ def main(global_config, **settings):
                           authentication_policy=authentication_policy)
 
     config.include(includeme)
+    if settings.get('tasks.transport', 'redis') == 'zmq':
+        start_queue_device(settings)
+
+    return config.make_wsgi_app()
+
+
+def start_queue_device(settings):
     log = logging.getLogger(__name__)
     log.info("Starting zmq QUEUE (%s ==> |QUEUE| ==> %s)",
              settings['zmq.queue_addr'], settings['zmq.daemon_addr'])
@@ -50,11 +59,12 @@ def main(global_config, **settings):
     device.setsockopt_out(zmq.IDENTITY, 'REQ')
     device.start()
 
-    return config.make_wsgi_app()
-
 
 def includeme(config):
     Environment.initialize(config.registry.settings, None)
+    Task.configure(config.registry.settings)
+    # load the commands now, not while serving the first task submission
+    get_commands()
     config.include(add_routes)
     config.add_renderer('taskresponse',
                         'aybu.manager.rest.renderers.TaskResponseRender')
@@ -68,6 +78,7 @@ def add_routes(config):
     config.add_route('alias', '/aliases/{domain}', factory=aclfct)
     config.add_route('archives', '/archives', factory=aclfct)
     config.add_route('archive', '/archives/{name}', factory=aclfct)
+    config.add_route('commands', '/commands', factory=aclfct)
     config.add_route('environments', '/environments', factory=aclfct)
     config.add_route('environment', '/environments/{name}', factory=aclfct)
     config.add_route('groups', '/groups', factory=aclfct)
@@ -82,9 +93,12 @@ def add_routes(config):
                      factory=aclfct)
     config.add_route('redirects', '/redirects', factory=aclfct)
     config.add_route('redirect', '/redirects/{source}', factory=aclfct)
+    config.add_route('stats_queue', '/stats/queue', factory=aclfct)
+    config.add_route('stats_tasks', '/stats/tasks', factory=aclfct)
     config.add_route('tasks', '/tasks', factory=aclfct)
     config.add_route('task', '/tasks/{uuid}', factory=aclfct)
     config.add_route('tasklogs', '/tasks/{uuid}/logs', factory=aclfct)
+    config.add_route('taskevents', '/tasks/{uuid}/events', factory=aclfct)
     config.add_route('themes', '/themes', factory=aclfct)
     config.add_route('theme', '/themes/{name}', factory=aclfct)
     config.add_route('users', '/users', factory=aclfct)
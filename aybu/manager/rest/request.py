@@ -18,20 +18,36 @@ limitations under the License.
 
 import logging
 import datetime
-import redis
-import zmq
+import time
 from aybu.core.request import BaseRequest
-from aybu.manager.rest.zmq_util import ZmqTaskSender
-from aybu.manager.task import Task
+from aybu.manager.daemon.commands import get_commands
+from aybu.manager.exc import ParamsError
+from aybu.manager.rest.zmq_util import (ZmqTaskSender,
+                                       get_context)
+from aybu.manager.task import (Task,
+                              TaskQueue,
+                              TaskResponse,
+                              TaskSchedule,
+                              taskpriority,
+                              redis_client_from_settings)
+
+
+def check_task(command, args):
+    """ raises ParamsError unless the workers can execute the command
+        with the given arguments """
+    commands = get_commands()
+    if command not in commands:
+        raise ParamsError('Unknown command {}'.format(command))
+    commands[command].check_args(args)
 
 
 class Request(BaseRequest):
 
     _redis = None
 
-    def __init__(self, *args, **kwargs):
-        super(Request, self).__init__(*args, **kwargs)
-        self.zmq_context = zmq.Context()
+    @property
+    def zmq_context(self):
+        return get_context()
 
     def _finished_callback(self, request):
         try:
@@ -44,26 +60,104 @@ class Request(BaseRequest):
         if self._redis:
             return self._redis
 
-        redis_opts = {k.replace('redis.', ''): self.registry.settings[k]
-                      for k in self.registry.settings
-                      if k.startswith('redis.')}
-        if 'port' in redis_opts:
-            redis_opts['port'] = int(redis_opts['port'])
-
-        self._redis = redis.StrictRedis(**redis_opts)
+        self._redis = redis_client_from_settings(self.registry.settings)
         return self._redis
 
-    def submit_task(self, command, **data):
-        s = ZmqTaskSender(self)
+    def task_priority(self, command):
+        """ priority from the X-Task-Priority header, or from the
+            'tasks.priority.$command' or 'tasks.priority.$module' settings """
+        priority = self.headers.get('X-Task-Priority')
+        if not priority:
+            settings = self.registry.settings
+            module = command.split('.')[0]
+            priority = settings.get('tasks.priority.{}'.format(command),
+                            settings.get('tasks.priority.{}'.format(module),
+                                         taskpriority.NORMAL))
+
+        priority = priority.strip().lower()
+        if priority not in taskpriority:
+            raise ParamsError('Invalid task priority {}'.format(priority))
+
+        return priority
+
+    def task_schedule(self):
+        """ dict of the TaskSchedule.add() arguments from the headers:
+            X-Task-Run-At, a timestamp or a 'YYYY-MM-DD HH:MM:SS' local time,
+            X-Task-Every, X-Task-Jitter, in seconds, and
+            X-Task-Max-Concurrency, or None if the task is not scheduled """
+        headers = self.headers
+        if 'X-Task-Run-At' not in headers and 'X-Task-Every' not in headers:
+            return None
+
+        def positive(header, value, zero=False):
+            # 'nan' and 'inf' are valid floats too
+            if not (0 <= value if zero else 0 < value) or \
+               not value < float('inf'):
+                raise ValueError('{} must be a positive number, not {}'
+                                 .format(header, headers[header]))
+            return value
+
+        schedule = dict(run_at=time.time(), every=0, jitter=0,
+                        max_concurrency=0)
+        try:
+            run_at = headers.get('X-Task-Run-At')
+            if run_at is not None:
+                try:
+                    run_at = float(run_at)
+                except ValueError:
+                    date = Task.parse_datetime(
+                                run_at.strip().replace('T', ' '))
+                    if date is None:
+                        raise ValueError('Invalid X-Task-Run-At {}'
+                                         .format(run_at))
+                    run_at = Task.timestamp(date)
+                schedule['run_at'] = positive('X-Task-Run-At', run_at)
+
+            # no jitter and no max concurrency by default
+            for name, header, type_, zero in (
+                            ('every', 'X-Task-Every', float, False),
+                            ('jitter', 'X-Task-Jitter', float, True),
+                            ('max_concurrency', 'X-Task-Max-Concurrency',
+                             int, True)):
+                if header in headers:
+                    schedule[name] = positive(header, type_(headers[header]),
+                                              zero)
+
+        except ValueError as e:
+            raise ParamsError(e)
+
+        return schedule
+
+    def submit_task(self, command, verbose=False, **data):
+        """ data are the arguments of the command, verbose sets the
+            level of the task logs to DEBUG """
         uuid = self.headers.get('X-Task-UUID')
-        verbose = data.pop('verbose', False)
+        # reject what the workers would not execute before enqueueing it
+        check_task(command, [k for k, v in data.iteritems() if v is not None])
 
         args = {"_arg.{}".format(k): v
                 for k, v in data.iteritems() if not v is None}
+        args['priority'] = self.task_priority(command)
         if verbose:
             args['log_level'] = logging.DEBUG
+        schedule = self.task_schedule()
+        settings = self.registry.settings
+        use_zmq = settings.get('tasks.transport', 'redis') == 'zmq'
+        # tasks to be queued are created and queued in a single transaction
+        pipe = None if schedule or use_zmq else self.redis.pipeline()
 
         task = Task(redis_client=self.redis,
                     requested=datetime.datetime.now(),
-                    command=command, uuid=uuid, **args)
-        return s.submit(task)
+                    command=command, uuid=uuid, pipeline=pipe, **args)
+
+        if schedule:
+            TaskSchedule(self.redis).add(task, **schedule)
+            return TaskResponse(task, dict(success=True,
+                                           message='Task scheduled'))
+
+        if use_zmq:
+            return ZmqTaskSender(self).submit(task)
+
+        TaskQueue.from_settings(self.redis, settings).push(task, pipeline=pipe)
+        pipe.execute()
+        return TaskResponse(task, dict(success=True, message='Task enqueued'))
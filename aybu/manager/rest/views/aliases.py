@@ -61,8 +61,10 @@ def info(context, request):
              renderer='taskresponse')
 def delete(context, request):
     domain = request.matchdict['domain']
-    Alias.get(request.db_session, domain)
-    return request.submit_task('alias.delete', domain=domain)
+    alias = Alias.get(request.db_session, domain)
+    # the instance serving the alias is rewritten too: lock it
+    return request.submit_task('alias.delete', domain=domain,
+                               owner_id=alias.instance_id)
 
 
 @view_config(route_name='alias', request_method='PUT',
@@ -71,7 +73,7 @@ def update(context, request):
 
     params = dict()
     domain = request.matchdict['domain']
-    Alias.get(request.db_session, domain)
+    alias = Alias.get(request.db_session, domain)
 
     try:
         if "destination" in request.params:
@@ -91,4 +93,5 @@ def update(context, request):
         raise ParamsError("Missing update fields")
 
     params['domain'] = domain
+    params['owner_id'] = alias.instance_id
     return request.submit_task('alias.update', **params)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+from pyramid.view import view_config
+from aybu.manager.daemon.commands import get_commands
+
+
+log = logging.getLogger(__name__)
+
+
+@view_config(route_name='commands', request_method=('HEAD', 'GET'))
+def list(context, request):
+    """ the commands the workers can execute, with their arguments """
+    return {name: command.to_dict()
+            for name, command in get_commands().iteritems()}
@@ -63,6 +63,8 @@ def generate_empty_response(context, request, status, add_headers={}):
 
 @view_config(route_name='archives', request_method=DISABLED_METH_COLL)
 @view_config(route_name='archive', request_method=DISABLED_METH_OBJ)
+@view_config(route_name='commands',
+             request_method=DISABLED_METH_COLL + ('POST',))
 @view_config(route_name='instances', request_method=('DELETE', 'OPTIONS',
                                                      'TRACE', 'CONNECT'))
 @view_config(route_name='instance', request_method=DISABLED_METH_OBJ)
@@ -79,12 +81,18 @@ def generate_empty_response(context, request, status, add_headers={}):
 @view_config(route_name='user', request_method=DISABLED_METH_OBJ)
 @view_config(route_name='user_instances',
              request_method=DISABLED_METH_COLL + ('POST',))
+@view_config(route_name='stats_queue',
+             request_method=DISABLED_METH_COLL + ('POST',))
+@view_config(route_name='stats_tasks',
+             request_method=DISABLED_METH_COLL + ('POST',))
 @view_config(route_name='tasks',
              request_method=('POST', 'PUT', 'OPTIONS', 'TRACE', 'CONNECT'))
 @view_config(route_name='task',
              request_method=('POST', 'PUT', 'OPTIONS', 'TRACE', 'CONNECT'))
 @view_config(route_name='tasklogs',
              request_method=('POST', 'PUT', 'OPTIONS', 'TRACE', 'CONNECT'))
+@view_config(route_name='taskevents',
+             request_method=DISABLED_METH_COLL + ('POST',))
 @view_config(route_name='environments', request_method=DISABLED_METH_COLL)
 @view_config(route_name='environment', request_method=DISABLED_METH_OBJ)
 @view_config(route_name='groups', request_method=DISABLED_METH_COLL)
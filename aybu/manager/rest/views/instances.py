@@ -68,8 +68,8 @@ def deploy(context, request):
             default_language=request.params.get('default_language', u'it'),
             database_password=request.params.get('database_password'),
             enabled=True if request.params.get('enabled') else False,
-            verbose=True if request.params.get('verbose') else False,
         )
+        verbose = True if request.params.get('verbose') else False
         check_domain_not_used(request, params['domain'])
         params['domain'] = validate_hostname(params['domain'])
         # try to get the instance, as it MUST not exists
@@ -117,7 +117,8 @@ def deploy(context, request):
         else:
             log.info("Submitting task")
             # relations exists, submit tasks
-            return request.submit_task('instance.deploy', **params)
+            return request.submit_task('instance.deploy', verbose=verbose,
+                                       **params)
 
     else:
         # found instance, conflict
@@ -194,6 +195,24 @@ def migrate_all(context, request):
     return request.submit_task('instance.migrate', id='all', revision=revision)
 
 
+@view_config(route_name='instances', request_method="PUT",
+             request_param='action=backup', renderer='taskresponse')
+def backup_all(context, request):
+    params = {p: request.params[p]
+              for p in ('environment', 'domains', 'enabled', 'concurrency')
+              if request.params.get(p)}
+    if 'concurrency' in params:
+        try:
+            if int(params['concurrency']) < 1:
+                raise ValueError()
+        except ValueError:
+            raise ParamsError('Invalid concurrency {}'
+                              .format(params['concurrency']))
+
+    # the daemon resolves the filters to the instance ids to lock
+    return request.submit_task('instance.backup', **params)
+
+
 @view_config(route_name='instance', request_method='PUT',
              request_param='action', renderer='taskresponse')
 @view_config(route_name='instance', request_method='DELETE',
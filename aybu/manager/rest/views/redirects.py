@@ -64,8 +64,10 @@ def info(context, request):
              renderer='taskresponse')
 def delete(context, request):
     source = request.matchdict['source']
-    Redirect.get(request.db_session, source)
-    return request.submit_task('redirect.delete', source=source)
+    redirect = Redirect.get(request.db_session, source)
+    # the instance serving the redirect is rewritten too: lock it
+    return request.submit_task('redirect.delete', source=source,
+                               owner_id=redirect.instance_id)
 
 
 @view_config(route_name='redirect', request_method='PUT',
@@ -74,7 +76,7 @@ def update(context, request):
 
     params = dict()
     source = request.matchdict['source']
-    Redirect.get(request.db_session, source)
+    redirect = Redirect.get(request.db_session, source)
 
     specs = (
        ('new_source', check_domain_not_used, [request]),
@@ -99,6 +101,7 @@ def update(context, request):
         raise ParamsError("Missing update fields")
 
     params['source'] = source
+    params['owner_id'] = redirect.instance_id
     if "destination" in params:
         params['instance_id'] = params['destination'].id
         del params['destination']
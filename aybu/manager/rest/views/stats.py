@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+from pyramid.view import view_config
+from aybu.manager.task import (Task,
+                              TaskQueue,
+                              TaskSchedule,
+                              TaskStats)
+
+
+log = logging.getLogger(__name__)
+
+
+@view_config(route_name='stats_queue', request_method=('HEAD', 'GET'))
+def queue(context, request):
+    queue = TaskQueue(request.redis)
+    res = {'lanes.{}'.format(lane): depth
+           for lane, depth in queue.stats().iteritems()}
+    res['processing'] = len(queue.processing)
+    res['scheduled'] = len(TaskSchedule(request.redis))
+    return res
+
+
+@view_config(route_name='stats_tasks', request_method=('HEAD', 'GET'))
+def tasks(context, request):
+    """ number of tasks by status, and the latency histograms of task
+        phases by command, in 'timing' """
+    counts = Task.count_by_status(redis_client=request.redis)
+    res = {'status.{}'.format(status): count
+           for status, count in counts.iteritems()}
+    res['timing'] = TaskStats(request.redis).histograms()
+    return res
@@ -16,10 +16,25 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
+import datetime
+import json
 import logging
+import time
 from pyramid.view import view_config
-from pyramid.httpexceptions import HTTPNoContent
-from aybu.manager.task import Task
+from pyramid.httpexceptions import (HTTPAccepted,
+                                    HTTPConflict,
+                                    HTTPNoContent)
+from pyramid.response import Response
+from aybu.manager.exc import (ParamsError,
+                              TaskNotFoundError)
+from aybu.manager.models import ArchivedTask
+from aybu.manager.rest.zmq_util import (subscribe,
+                                        wait_message)
+from aybu.manager.task import (Task,
+                              TaskQueue,
+                              TaskSchedule,
+                              taskstatus)
 
 
 log = logging.getLogger(__name__)
@@ -30,37 +45,289 @@ def get_task(request):
                     redis_client=request.redis)
 
 
+def get_task_or_archived(request):
+    """ tasks past their retention time are read from the archive """
+    try:
+        return get_task(request)
+
+    except TaskNotFoundError:
+        return ArchivedTask.get(request.db_session,
+                                request.matchdict['uuid'])
+
+
 @view_config(route_name='tasks', request_method=('HEAD', 'GET'))
 def list(context, request):
-    return {task.uuid: task.to_dict() for task in
-            Task.all(redis_client=request.redis)}
+    """ With 'limit' (and 'before', the cursor returned by the previous
+        page) returns a page of tasks, most recently requested first,
+        else all the tasks by uuid, or only those with the given 'status'.
+        Archived tasks are included.
+    """
+    params = request.params
+    if 'status' in params:
+        status = params['status'].upper()
+        if status not in taskstatus:
+            raise ParamsError('Invalid status {}'.format(params['status']))
+
+        uuids = Task.with_status(status, redis_client=request.redis)
+        archived = ArchivedTask.with_status(request.db_session, status)
+        return with_archived(Task.load_many(uuids, redis_client=request.redis),
+                             archived)
+
+    if 'limit' not in params and 'before' not in params:
+        uuids = [uuid for uuid in request.redis.smembers('tasks')]
+        archived = ArchivedTask.all(request.db_session)
+        return with_archived(Task.load_many(uuids, redis_client=request.redis),
+                             archived)
+
+    try:
+        limit = int(params.get('limit', 50))
+        before = float(params['before']) if 'before' in params else None
+        if limit < 1:
+            raise ValueError('limit must be positive')
+
+    except ValueError as e:
+        raise ParamsError(e)
+
+    tasks, cursor = Task.page(limit, before, redis_client=request.redis)
+    page = [(Task.timestamp(Task.parse_datetime(values.get('requested'))),
+             dict(values, uuid=uuid))
+            for uuid, values in tasks.iteritems()]
+    if before is not None:
+        before = datetime.datetime.fromtimestamp(before)
+    archived = ArchivedTask.page(request.db_session, limit, before)
+    page.extend((Task.timestamp(task.requested),
+                 dict(task.to_dict(), uuid=task.uuid))
+                for task in archived)
+    page.sort(key=lambda item: item[0], reverse=True)
+    page = page[:limit]
+    cursor = repr(page[-1][0]) if len(page) == limit else None
+    return dict(tasks=[values for timestamp, values in page], next=cursor)
+
+
+def with_archived(tasks, archived):
+    """ tasks (uuid => fields, as returned by Task.load_many) and the
+        archived ones, by uuid """
+    tasks = dict(tasks)
+    for task in archived:
+        tasks.setdefault(task.uuid, task.to_dict())
+    return collections.OrderedDict(sorted(tasks.iteritems()))
 
 
 @view_config(route_name='tasks', request_method='DELETE')
 def flush(context, request):
-    for task in Task.all(redis_client=request.redis):
-        task.remove()
+    Task.flush(redis_client=request.redis)
     raise HTTPNoContent()
 
 
 @view_config(route_name='task', request_method=('HEAD', 'GET'))
 def info(context, request):
-    return get_task(request).to_dict()
+    return get_task_or_archived(request).to_dict()
 
 
 @view_config(route_name='task', request_method='DELETE')
 def remove(context, request):
-    get_task(request).remove()
+    """ With 'cancel', cancels the task instead of removing it: a task
+        still waiting to be executed is removed from the queue and marked
+        as CANCELLED (204), a running one is asked to stop (202), so that
+        its actions are rolled back. Cancelling the next occurrence of a
+        scheduled task removes the whole schedule, and so does cancelling
+        the schedule id (the uuid of its first occurrence), even once that
+        occurrence has completed. """
+    if 'cancel' in request.params and \
+       TaskSchedule(request.redis).cancel(request.matchdict['uuid']):
+        try:
+            task = get_task(request)
+        except TaskNotFoundError:
+            raise HTTPNoContent()
+        if task.is_done:
+            raise HTTPNoContent()
+
+    task = get_task(request)
+    if 'cancel' not in request.params:
+        task.remove()
+        raise HTTPNoContent()
+
+    if task.is_done:
+        raise HTTPConflict()
+
+    # the executor checks the flag before starting and while running
+    task.update(cancel=1)
+    if task.status == taskstatus.STARTED:
+        raise HTTPAccepted()
+
+    if task.status == taskstatus.SCHEDULED:
+        TaskSchedule(request.redis).remove(task.get('schedule', task.uuid))
+
+    queue = TaskQueue.from_settings(request.redis, request.registry.settings)
+    if not queue.remove(task) and task.status == taskstatus.QUEUED:
+        # already popped, the executor will cancel it
+        raise HTTPAccepted()
+
+    task.update(status=taskstatus.CANCELLED, finished=datetime.datetime.now(),
+                result='Task cancelled')
     raise HTTPNoContent()
 
 
 @view_config(route_name='tasklogs', request_method='GET')
 def get_logs(context, request):
+    """ Without 'since', returns the list of all the messages.
+        With 'since=$cursor', returns only the messages logged after the
+        cursor and the cursor for the next call ('since=0' to start);
+        with 'wait=$seconds' too, waits for new messages up to that
+        time if there are none yet and the task is still running.
+    """
     level = request.params.get('level', 'debug').upper()
-    return get_task(request).get_logs(level)
+    if 'since' not in request.params:
+        return get_task_or_archived(request).get_logs(level)
+
+    task = get_task(request)
+
+    try:
+        since = int(request.params['since'])
+        wait = float(request.params.get('wait', 0))
+        if since < 0 or wait < 0:
+            raise ValueError('since and wait cannot be negative')
+
+    except ValueError as e:
+        raise ParamsError(e)
+
+    settings = request.registry.settings
+    wait = min(wait, float(settings.get('tasks.logs.max_wait', 30)))
+    logs, cursor = tail_logs(task, level, since, wait,
+                             settings['zmq.status_pub_addr'])
+    return dict(logs=logs, next=cursor, status=task.status)
+
+
+def tail_logs(task, level, since, wait, status_pub_addr):
+    """ waits on the status publisher for messages about the task """
+    logs, cursor = task.tail_logs(level, since)
+    if logs or not wait or task.is_done:
+        return logs, cursor
+
+    socket = subscribe(status_pub_addr, task.uuid)
+    try:
+        deadline = time.time() + wait
+        # records are published before they are stored in redis:
+        # once something has been published, poll redis more often
+        poll = wait
+        while True:
+            # read again after subscribing, not to miss any message
+            logs, cursor = task.tail_logs(level, cursor)
+            remaining = deadline - time.time()
+            if logs or remaining <= 0 or task.is_done:
+                return logs, cursor
+
+            if wait_message(socket, min(poll, remaining)):
+                poll = 0.25
+
+    finally:
+        socket.close()
 
 
 @view_config(route_name='tasklogs', request_method='DELETE')
 def flush_logs(context, request):
     get_task(request).flush_logs()
     raise HTTPNoContent()
+
+
+@view_config(route_name='taskevents', request_method='GET')
+def events(context, request):
+    """ Events about the task published by the daemon: 'log' for every
+        log record, 'progress' for the progress reported by the command,
+        'finished' with the final status when the task ends.
+        Clients accepting 'text/event-stream' get a stream of server sent
+        events, closed when the task ends or after 'tasks.events.max_duration'
+        seconds; others get the events received within 'wait' seconds
+        (long poll), as soon as there is at least one.
+    """
+    task = get_task(request)
+    settings = request.registry.settings
+    # subscribe before looking at the status, not to miss the end
+    socket = subscribe(settings['zmq.status_pub_addr'],
+                       "{}.".format(task.uuid))
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        max_duration = float(settings.get('tasks.events.max_duration', 600))
+        heartbeat = float(settings.get('tasks.events.heartbeat', 15))
+        response = Response(content_type='text/event-stream',
+                            app_iter=stream_events(task, socket, max_duration,
+                                                   heartbeat))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    try:
+        try:
+            wait = float(request.params.get('wait', 0))
+            if wait < 0:
+                raise ValueError('wait cannot be negative')
+
+        except ValueError as e:
+            raise ParamsError(e)
+
+        wait = min(wait, float(settings.get('tasks.logs.max_wait', 30)))
+        messages = [] if task.is_done else wait_message(socket, wait)
+        res = [dict(event=event, data=data) for event, data in
+               (task_event(task, message) for message in messages)]
+        if task.is_done and not any(e['event'] == 'finished' for e in res):
+            res.append(dict(event='finished', data=finished_data(task)))
+
+        return dict(events=res, status=task.status)
+
+    finally:
+        socket.close()
+
+
+def finished_data(task):
+    return dict(status=task.status, result=task.get('result', ''))
+
+
+def task_event(task, message):
+    """ (event name, data) for a message published about the task on
+        the '$uuid.$LEVEL[.$topic]' or '$uuid.$event' topics """
+    topic, data = message[0], message[-1]
+    kind = topic.split('.')[1] if '.' in topic else ''
+    if kind == 'finished':
+        return 'finished', finished_data(task)
+
+    if kind == 'progress':
+        return 'progress', json.loads(data)
+
+    data = data.decode('utf-8', 'replace')
+    if kind in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+        return 'log', dict(level=kind, message=data)
+
+    return kind, data
+
+
+def stream_events(task, socket, max_duration, heartbeat):
+    def event(name, data):
+        return "event: {}\ndata: {}\n\n".format(name, json.dumps(data))
+
+    try:
+        deadline = time.time() + max_duration
+        yield "retry: 2000\n\n"
+        if task.is_done:
+            yield event('finished', finished_data(task))
+            return
+
+        while time.time() < deadline:
+            messages = wait_message(socket,
+                                    min(heartbeat, deadline - time.time()))
+            if not messages:
+                # the 'finished' message may have been lost: the task is
+                # read from redis, not from a snapshot, on every heartbeat
+                if task.is_done:
+                    yield event('finished', finished_data(task))
+                    return
+
+                yield ": keepalive\n\n"
+                continue
+
+            for message in messages:
+                name, data = task_event(task, message)
+                yield event(name, data)
+                if name == 'finished':
+                    return
+
+    finally:
+        socket.close()
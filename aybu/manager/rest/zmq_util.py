@@ -17,11 +17,110 @@ limitations under the License.
 """
 
 import logging
+import os
+import threading
 import zmq
 from aybu.manager.utils.decorators import classproperty
 from aybu.manager.task import taskstatus, TaskResponse
 
 
+__all__ = ['ZmqTaskSender', 'ZmqSocketPool', 'get_context', 'get_socket_pool',
+           'subscribe', 'wait_message']
+_lock = threading.Lock()
+_context = None
+_context_pid = None
+_pools = {}
+
+
+def get_context():
+    """ Returns the zmq context of the current process.
+        Creating a context spawns its I/O threads, so it is created once
+        per process (and again in forked children) """
+    global _context, _context_pid
+    with _lock:
+        if _context is None or _context_pid != os.getpid():
+            _context = zmq.Context()
+            _context_pid = os.getpid()
+            _pools.clear()
+        return _context
+
+
+def get_socket_pool(addr, size):
+    """ Returns the process wide pool of REQ sockets connected to addr """
+    context = get_context()
+    with _lock:
+        if addr not in _pools:
+            _pools[addr] = ZmqSocketPool(context, addr, size)
+        return _pools[addr]
+
+
+def subscribe(addr, *topics):
+    """ Returns a SUB socket connected to addr and subscribed to topics """
+    socket = get_context().socket(zmq.SUB)
+    socket.setsockopt(zmq.LINGER, 0)
+    for topic in topics:
+        socket.setsockopt(zmq.SUBSCRIBE, topic)
+    socket.connect(addr)
+    return socket
+
+
+def wait_message(socket, timeout):
+    """ Waits up to timeout seconds for messages on socket. Returns the
+        list of the messages (lists of frames) that have been received """
+    messages = []
+    # a negative timeout would wait forever
+    if not socket.poll(max(int(timeout * 1000), 0)):
+        return messages
+
+    while True:
+        try:
+            messages.append(socket.recv_multipart(zmq.NOBLOCK))
+        except zmq.ZMQError as e:
+            if e.errno != zmq.EAGAIN:
+                raise
+            return messages
+
+
+class ZmqSocketPool(object):
+    """ A pool of connected REQ sockets.
+        Sockets must be given back with release() after a complete
+        send/recv cycle, or closed with discard() when a reply did not
+        come in time, as a REQ socket cannot send again before receiving
+        ("lazy pirate" pattern).
+    """
+
+    def __init__(self, context, addr, size):
+        self.log = logging.getLogger("{}.ZmqSocketPool".format(__name__))
+        self.context = context
+        self.addr = addr
+        self.size = size
+        self.lock = threading.Lock()
+        self.sockets = []
+
+    def acquire(self):
+        with self.lock:
+            if self.sockets:
+                return self.sockets.pop()
+
+        self.log.info("Created zmq socket, connecting to %s", self.addr)
+        socket = self.context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.addr)
+        return socket
+
+    def release(self, socket):
+        with self.lock:
+            if len(self.sockets) < self.size:
+                self.sockets.append(socket)
+                return
+
+        socket.close()
+
+    def discard(self, socket):
+        self.log.debug("Discarding zmq socket connected to %s", self.addr)
+        socket.close()
+
+
 class ZmqTaskSender(object):
 
     @classproperty
@@ -35,41 +134,46 @@ class ZmqTaskSender(object):
         return cls._log
 
     def __init__(self, request):
-        self.context = request.zmq_context
-        self.remote_addr = request.registry.settings['zmq.queue_addr']
-        self.timeout = int(request.registry.settings['zmq.timeout'])
-        self.socket = self.context.socket(zmq.REQ)
-        self.log.info("Created zmq socket, connecting to %s", self.remote_addr)
-        self.socket.connect(self.remote_addr)
-        self.socket.setsockopt(zmq.LINGER, 0)
-        self.poller = zmq.Poller()
-        self.poller.register(self.socket, zmq.POLLIN)
+        settings = request.registry.settings
+        self.remote_addr = settings['zmq.queue_addr']
+        self.timeout = int(settings['zmq.timeout'])
+        self.retries = int(settings.get('zmq.retries', 1))
+        self.pool = get_socket_pool(self.remote_addr,
+                                    int(settings.get('zmq.pool_size', 8)))
 
     def submit(self, task, flags=0):
-        try:
-            data = task.uuid
-            self.log.debug("Sending message: %s (flags=%s)", data, flags)
-            self.socket.send(data, flags)
-        except:
-            self.log.exception('Error sending message to zmq')
-
-        else:
+        data = task.uuid
+        for attempt in xrange(self.retries):
+            socket = self.pool.acquire()
             try:
+                self.log.debug("Sending message: %s (flags=%s)", data, flags)
+                socket.send(data, flags)
+                poller = zmq.Poller()
+                poller.register(socket, zmq.POLLIN)
                 self.log.debug("Awaiting response from daemon")
-                if self.poller.poll(self.timeout):
-                    response = self.socket.recv_json()
-                    self.log.debug("Received response from daemon: %s", response)
+                if poller.poll(self.timeout):
+                    response = socket.recv_json()
+                    self.log.debug("Received response from daemon: %s",
+                                   response)
+                    self.pool.release(socket)
                     return TaskResponse(task, response)
 
-                task.status = taskstatus.DEFERRED
-                self.log.error("%s: Timeout while reading from daemon", task)
-                return TaskResponse(
-                        task,
-                        dict(success=True,
-                             message='Message enqueued to be delivered')
-                )
-
             except Exception as e:
-                self.log.exception('Error reading response from zmq')
+                self.log.exception('Error talking to zmq')
+                self.pool.discard(socket)
                 task.status = taskstatus.ERROR
                 return TaskResponse(task, dict(success=False, message=str(e)))
+
+            # no reply: the socket cannot be reused
+            self.pool.discard(socket)
+            self.log.warning("%s: Timeout while reading from daemon "
+                             "(attempt %d of %d)", task, attempt + 1,
+                             self.retries)
+
+        task.status = taskstatus.DEFERRED
+        self.log.error("%s: Timeout while reading from daemon", task)
+        return TaskResponse(
+                task,
+                dict(success=True,
+                     message='Message enqueued to be delivered')
+        )
@@ -17,14 +17,23 @@ limitations under the License.
 """
 
 import collections
+import datetime
+import hashlib
+import json
 import logging
+import os
+import random
 import redis
+import threading
+import time
 import uuid as uuid_module
+import zlib
 from aybu.manager.exc import TaskExistsError, TaskNotFoundError
 
 TaskStatus = collections.namedtuple('TaskStatus', ['ERROR', 'UNDEF', 'DEFERRED',
                                                    'QUEUED', 'STARTED',
-                                                   'FINISHED', 'FAILED'])
+                                                   'FINISHED', 'FAILED',
+                                                   'CANCELLED', 'SCHEDULED'])
 taskstatus = TaskStatus(
                 ERROR="ERROR",
                 UNDEF="UNDEF",
@@ -32,63 +41,345 @@ taskstatus = TaskStatus(
                 QUEUED="QUEUED",
                 STARTED="STARTED",
                 FINISHED="FINISHED",
-                FAILED="FAILED"
+                FAILED="FAILED",
+                CANCELLED="CANCELLED",
+                SCHEDULED="SCHEDULED"
 )
-__all__ = ['Task', 'taskstatus', 'TaskResponse']
+TaskPriority = collections.namedtuple('TaskPriority', ['HIGH', 'NORMAL',
+                                                       'LOW'])
+# lanes are drained in this order
+taskpriority = TaskPriority(
+                HIGH="high",
+                NORMAL="normal",
+                LOW="low"
+)
+__all__ = ['Task', 'taskstatus', 'taskpriority', 'TaskResponse', 'TaskQueue',
+           'TaskSchedule', 'TaskStats', 'redis_client_from_settings',
+           'redis_connection_pool']
+# 'redis.*' settings that are not strings
+REDIS_INT_OPTIONS = ('port', 'db', 'max_connections')
+REDIS_FLOAT_OPTIONS = ('socket_timeout', 'socket_connect_timeout',
+                       'pool_timeout')
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def redis_connection_pool(**options):
+    """ Returns the connection pool for the given StrictRedis options.
+        Pools are shared by all the clients of the current process, and
+        are not reused after a fork.
+        With max_connections, clients wait up to pool_timeout seconds (for
+        ever if not given) for a free connection instead of failing.
+    """
+    key = (os.getpid(), tuple(sorted(options.items())))
+    with _pools_lock:
+        if key not in _pools:
+            timeout = options.pop('pool_timeout', None)
+            if 'max_connections' in options:
+                pool = redis.BlockingConnectionPool(timeout=timeout, **options)
+            else:
+                pool = redis.ConnectionPool(**options)
+            _pools[key] = pool
+        return _pools[key]
+
+
+def redis_client_from_settings(settings, prefix='redis.'):
+    """ Returns a StrictRedis client configured by the 'redis.*' settings
+        (i.e. redis.host, redis.port, redis.max_connections,
+        redis.pool_timeout, redis.socket_timeout) using the shared
+        connection pool of the process.
+    """
+    options = {}
+    for key, value in settings.iteritems():
+        if not key.startswith(prefix):
+            continue
+
+        name = key[len(prefix):]
+        if name in REDIS_INT_OPTIONS:
+            value = int(value)
+        elif name in REDIS_FLOAT_OPTIONS:
+            value = float(value)
+        options[name] = value
+
+    return redis.StrictRedis(connection_pool=redis_connection_pool(**options))
 
 
 class Task(collections.MutableMapping):
     """ A dict mapped on redis that models a task.
-        tasks are referred by uuid
+        tasks are referred by uuid.
+        A task created with snapshot=True loads the whole hash once and
+        serves all reads from that copy, which is kept up to date with the
+        writes done through the task itself; use refresh() to read again
+        changes done by others.
     """
+
+    done_statuses = (taskstatus.FINISHED, taskstatus.FAILED, taskstatus.ERROR,
+                     taskstatus.CANCELLED)
+    # values and log messages longer than compress_threshold bytes are
+    # stored compressed; logs are capped to max_log_bytes per task.
+    # Both are set from the settings by configure()
+    compress_threshold = 4096
+    max_log_bytes = 0
+    compressed_marker = "\x00zlib:"
+    # levels of the per-level log lists used before the logs were stored
+    # in a single list: tasks created then may still have them
+    legacy_log_levels = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
     def __init__(self, redis_client=None, redis_conf=None, new=False,
-                 uuid=None, **kwargs):
+                 uuid=None, snapshot=False, pipeline=None, **kwargs):
 
         self.redis = self.redis_client_from_params(redis_conf, redis_client)
         uuid = uuid or uuid_module.uuid4().hex
 
         object.__setattr__(self, 'uuid', uuid)
-        self.key = "task:{uuid}".format(uuid=uuid)
-        self.logs_key = "{key}:logs".format(key=self.key)
-        self.logs_counter_key = "{key}:index".format(key=self.logs_key)
-        self.logs_levels_key = "logs:levels"
+        self.key, self.logs_key = self.keys_for(uuid)[:2]
+        self._snapshot = None
+        self._log_bytes = None
+        # callable(topic, message) publishing events about the task,
+        # set by the worker executing it
+        self.publisher = None
 
-        if new and self.redis_client.exists(self.key):
+        if new and self.redis.exists(self.key):
             raise TaskExistsError('a task with uuid {} already exists'
                                   .format(uuid))
 
-        else:
-            self.redis.sadd("tasks", self.uuid)
+        # register the task, set all the fields and read them back
+        # in a single round trip. If a pipeline is given the commands are
+        # queued on it and not executed, and the task is a snapshot of the
+        # given fields
+        pipe = self.redis.pipeline() if pipeline is None else pipeline
+        pipe.sadd("tasks", self.uuid)
+        if kwargs:
+            pipe.hmset(self.key, {k: self.encode_value(v)
+                                  for k, v in kwargs.iteritems()})
+        if 'status' in kwargs:
+            self.index_status(pipe, self.uuid, kwargs['status'])
+        if isinstance(kwargs.get('requested'), datetime.datetime):
+            pipe.zadd("tasks:index", self.timestamp(kwargs['requested']),
+                      self.uuid)
+        if pipeline is not None:
+            self._snapshot = {k: self.encode_value(v)
+                              for k, v in kwargs.iteritems()}
+            return
 
-        for k, v in kwargs.items():
-            self[k] = v
+        if snapshot:
+            pipe.hgetall(self.key)
+        result = pipe.execute()
+        if snapshot:
+            self._snapshot = result[-1]
 
     def to_dict(self):
         return {k: v for k, v in self.iteritems()}
 
+    @classmethod
+    def key_for(cls, uuid):
+        return "task:{uuid}".format(uuid=uuid)
+
+    @classmethod
+    def keys_for(cls, uuid, levels=()):
+        """ Returns all the redis keys of a task: the hash and the logs list,
+            followed by the logs keys of older versions ('task:$uuid:logs',
+            its ':index' counter and its ':$LEVEL' lists, for the standard
+            levels and the given ones).
+            Keys are named after the uuid only, so a task can be removed
+            without looking for its keys in the whole keyspace.
+        """
+        key = cls.key_for(uuid)
+        legacy_logs_key = "{key}:logs".format(key=key)
+        return [key, "{key}:log".format(key=key), legacy_logs_key,
+                "{key}:index".format(key=legacy_logs_key)] + \
+               ["{key}:{level}".format(key=legacy_logs_key, level=level)
+                for level in set(cls.legacy_log_levels).union(levels)]
+
+    @classmethod
+    def legacy_log_levels_in(cls, redis_client):
+        """ the level names recorded by older versions, logs of tasks
+            created then are split in one list per level """
+        return redis_client.zrange('logs:levels', 0, -1)
+
     @classmethod
     def redis_client_from_params(cls, redis_conf=None, redis_client=None):
         if not redis_conf and not redis_client:
             raise TypeError("redis_conf and redis_client cannot be both empty")
 
         elif not redis_client:
-            redis_client = redis.StrictRedis(**redis_conf)
+            redis_client = redis.StrictRedis(
+                        connection_pool=redis_connection_pool(**redis_conf))
 
         return redis_client
 
     @classmethod
-    def retrieve(cls, uuid, redis_conf=None, redis_client=None):
+    def configure(cls, settings):
+        """ 'tasks.compress.threshold': compress values and log messages
+            longer than that many bytes (0: never),
+            'tasks.logs.max_bytes': stop storing the logs of a task when
+            they take that many bytes (0: no limit) """
+        cls.compress_threshold = int(settings.get('tasks.compress.threshold',
+                                                  cls.compress_threshold))
+        cls.max_log_bytes = int(settings.get('tasks.logs.max_bytes',
+                                             cls.max_log_bytes))
+
+    @classmethod
+    def retrieve(cls, uuid, redis_conf=None, redis_client=None,
+                 snapshot=False):
         redis_client = cls.redis_client_from_params(redis_conf, redis_client)
         if not redis_client.sismember('tasks', uuid):
             raise TaskNotFoundError(uuid)
-        return cls(uuid=uuid, redis_client=redis_client)
+        return cls(uuid=uuid, redis_client=redis_client, snapshot=snapshot)
 
     @classmethod
-    def all(cls, redis_conf=None, redis_client=None):
+    def all(cls, redis_conf=None, redis_client=None, snapshot=False):
         redis_client = cls.redis_client_from_params(redis_conf, redis_client)
-        return (cls.retrieve(redis_client=redis_client, uuid=uuid)
+        return (cls.retrieve(redis_client=redis_client, uuid=uuid,
+                             snapshot=snapshot)
                 for uuid in redis_client.smembers('tasks'))
 
+    @classmethod
+    def status_key(cls, status):
+        return "tasks:status:{}".format(status)
+
+    @classmethod
+    def index_status(cls, pipeline, uuid, status):
+        """ queue on the pipeline the commands moving the task to the
+            'tasks:status:$status' set. Use a transactional pipeline to
+            change the index atomically.
+            Completed tasks are indexed by completion time too, in the
+            'tasks:done' sorted set. """
+        for other in taskstatus:
+            if other != status:
+                pipeline.srem(cls.status_key(other), uuid)
+        pipeline.sadd(cls.status_key(status), uuid)
+        if status in cls.done_statuses:
+            pipeline.zadd("tasks:done", time.time(), uuid)
+        else:
+            pipeline.zrem("tasks:done", uuid)
+
+    @classmethod
+    def fail(cls, uuid, result, redis_conf=None, redis_client=None):
+        """ marks as FAILED a task whose execution has been interrupted,
+            unless it has completed """
+        redis_client = cls.redis_client_from_params(redis_conf, redis_client)
+        task = cls(uuid=uuid, redis_client=redis_client, snapshot=True)
+        if not task.is_done:
+            task.update(status=taskstatus.FAILED, result=result,
+                        finished=datetime.datetime.now())
+
+    @classmethod
+    def done_before(cls, timestamp, limit, redis_conf=None,
+                    redis_client=None):
+        """ uuids of at most 'limit' tasks completed before timestamp """
+        redis_client = cls.redis_client_from_params(redis_conf, redis_client)
+        return redis_client.zrangebyscore("tasks:done", "-inf", timestamp,
+                                          start=0, num=limit)
+
+    @classmethod
+    def with_status(cls, status, redis_conf=None, redis_client=None):
+        """ uuids of the tasks with the given status """
+        redis_client = cls.redis_client_from_params(redis_conf, redis_client)
+        return redis_client.smembers(cls.status_key(status))
+
+    @classmethod
+    def count_by_status(cls, redis_conf=None, redis_client=None):
+        """ number of tasks for every status """
+        redis_client = cls.redis_client_from_params(redis_conf, redis_client)
+        pipe = redis_client.pipeline(transaction=False)
+        for status in taskstatus:
+            pipe.scard(cls.status_key(status))
+        return dict(zip(taskstatus, pipe.execute()))
+
+    @staticmethod
+    def timestamp(value):
+        """ score of a datetime in the 'tasks:index' sorted set """
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+
+    @staticmethod
+    def parse_datetime(value):
+        """ datetime for a value stored by redis (None if invalid) """
+        for format_ in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+            try:
+                return datetime.datetime.strptime(value or '', format_)
+            except ValueError:
+                continue
+        return None
+
+    @classmethod
+    def load_many(cls, uuids, redis_conf=None, redis_client=None):
+        """ Returns an ordered dict uuid => task fields for the given tasks,
+            read with a single pipeline. Missing tasks are skipped. """
+        redis_client = cls.redis_client_from_params(redis_conf, redis_client)
+        pipe = redis_client.pipeline(transaction=False)
+        for uuid in uuids:
+            pipe.hgetall(cls.key_for(uuid))
+        return collections.OrderedDict(
+                    (uuid, {k: cls.decode_value(v)
+                            for k, v in values.iteritems()})
+                    for uuid, values in zip(uuids, pipe.execute()) if values)
+
+    @classmethod
+    def page(cls, limit, before=None, redis_conf=None, redis_client=None):
+        """ Returns the last 'limit' tasks requested before the 'before'
+            timestamp (or the last ones), newest first, as returned by
+            load_many, and the cursor for the following page (None if
+            there are no more tasks). Tasks are indexed by request time
+            in the 'tasks:index' sorted set.
+        """
+        redis_client = cls.redis_client_from_params(redis_conf, redis_client)
+        max_ = "({!r}".format(float(before)) if before is not None else "+inf"
+        items = redis_client.zrevrangebyscore("tasks:index", max_, "-inf",
+                                              start=0, num=limit,
+                                              withscores=True)
+        tasks = cls.load_many([uuid for uuid, score in items],
+                              redis_client=redis_client)
+        cursor = repr(items[-1][1]) if len(items) == limit else None
+        return tasks, cursor
+
+    def refresh(self):
+        """ (re)load the snapshot of the task """
+        self._snapshot = self.redis.hgetall(self.key)
+
+    def update(self, mapping=(), pipeline=None, **kwargs):
+        """ set many fields with a single HMSET. If a pipeline is given
+            the command is queued on it and not executed """
+        values = {k: self.encode_value(v)
+                  for k, v in dict(mapping, **kwargs).iteritems()}
+        if not values:
+            return
+
+        pipe = pipeline
+        if pipe is None and 'status' in values:
+            pipe = self.redis.pipeline()
+
+        if pipe is None:
+            self.redis.hmset(self.key, values)
+
+        else:
+            pipe.hmset(self.key, values)
+            if 'status' in values:
+                self.index_status(pipe, self.uuid, values['status'])
+            if pipeline is None:
+                pipe.execute()
+
+        if self._snapshot is not None:
+            self._snapshot.update(values)
+
+    @classmethod
+    def encode_value(cls, value):
+        """ value as stored (and read back) by redis, compressed if longer
+            than compress_threshold """
+        if not isinstance(value, basestring):
+            value = str(value)
+        if cls.compress_threshold and len(value) > cls.compress_threshold:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            value = cls.compressed_marker + zlib.compress(value)
+        return value
+
+    @classmethod
+    def decode_value(cls, value):
+        if value is not None and value.startswith(cls.compressed_marker):
+            return zlib.decompress(value[len(cls.compressed_marker):])
+        return value
+
     @property
     def status(self):
         try:
@@ -141,105 +432,277 @@ class Task(collections.MutableMapping):
         super(Task, self).__setattr__(attr, value)
 
     def keys(self):
+        if self._snapshot is not None:
+            return self._snapshot.keys()
         return self.redis.hkeys(self.key)
 
     def values(self):
-        return self.redis.hvals(self.key)
+        if self._snapshot is not None:
+            values = self._snapshot.values()
+        else:
+            values = self.redis.hvals(self.key)
+        return [self.decode_value(v) for v in values]
 
     def items(self):
-        return self.redis.hgetall(self.key).items()
+        if self._snapshot is not None:
+            items = self._snapshot.items()
+        else:
+            items = self.redis.hgetall(self.key).items()
+        return [(k, self.decode_value(v)) for k, v in items]
+
+    def iteritems(self):
+        return iter(self.items())
 
     def __iter__(self):
-        return iter(self.redis.hkeys(self.key))
+        return iter(self.keys())
 
     def __len__(self):
+        if self._snapshot is not None:
+            return len(self._snapshot)
         return self.redis.hlen(self.key)
 
     def __contains__(self, item):
+        if self._snapshot is not None:
+            return item in self._snapshot
         return self.redis.hexists(self.key, item)
 
     def __getitem__(self, item):
-        value = self.redis.hget(self.key, item)
+        if self._snapshot is not None:
+            value = self._snapshot.get(item)
+        else:
+            value = self.redis.hget(self.key, item)
         if value is None:
             raise KeyError(item)
-        return value
+        return self.decode_value(value)
 
     def __delitem__(self, item):
         if item not in self:
             raise KeyError(item)
         self.redis.hdel(self.key, item)
+        if self._snapshot is not None:
+            self._snapshot.pop(item, None)
 
     def __setitem__(self, item, value):
+        if item == 'status':
+            # keep the status index up to date
+            self.update({item: value})
+            return
+
+        value = self.encode_value(value)
         self.redis.hset(self.key, item, value)
+        if self._snapshot is not None:
+            self._snapshot[item] = value
+
+    @classmethod
+    def flush(cls, redis_conf=None, redis_client=None, batch=500):
+        """ remove all the tasks and their logs, the queue and the
+            schedules. The set of tasks is
+            scanned incrementally and tasks are deleted 'batch' at time,
+            one pipeline per batch, so redis is never blocked for long.
+            Returns the number of removed tasks.
+        """
+        redis_client = cls.redis_client_from_params(redis_conf, redis_client)
+        removed = 0
+        uuids = []
+        for uuid in redis_client.sscan_iter('tasks', count=batch):
+            uuids.append(uuid)
+            if len(uuids) >= batch:
+                removed += cls._remove_many(redis_client, uuids)
+                uuids = []
+
+        if uuids:
+            removed += cls._remove_many(redis_client, uuids)
+
+        # the queue lanes and the schedules refer to removed tasks only,
+        # and so do the level names of the logs of older versions
+        keys = ["logs:levels"]
+        for pattern in ("tasks:queue*", "tasks:schedule*"):
+            keys.extend(redis_client.scan_iter(pattern, count=batch))
+        redis_client.delete(*keys)
+        return removed
+
+    @classmethod
+    def remove_many(cls, uuids, redis_conf=None, redis_client=None):
+        """ remove the given tasks with a single pipeline """
+        redis_client = cls.redis_client_from_params(redis_conf, redis_client)
+        return cls._remove_many(redis_client, uuids)
+
+    @classmethod
+    def _remove_many(cls, redis_client, uuids):
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.srem('tasks', *uuids)
+        pipe.zrem('tasks:index', *uuids)
+        pipe.zrem('tasks:done', *uuids)
+        for status in taskstatus:
+            pipe.srem(cls.status_key(status), *uuids)
+        levels = cls.legacy_log_levels_in(redis_client)
+        for uuid in uuids:
+            pipe.delete(*cls.keys_for(uuid, levels))
+        pipe.execute()
+        return len(uuids)
 
     def remove(self):
         """ remove the task and all its logs from redis """
-        self.redis.srem('tasks', self.uuid)
-        for key in self.redis.keys("{}*".format(self.key)):
-            self.redis.delete(key)
+        pipe = self.redis.pipeline()
+        pipe.srem('tasks', self.uuid)
+        pipe.zrem('tasks:index', self.uuid)
+        pipe.zrem('tasks:done', self.uuid)
+        for status in taskstatus:
+            pipe.srem(self.status_key(status), self.uuid)
+        pipe.delete(*self.keys_for(self.uuid,
+                                   self.legacy_log_levels_in(self.redis)))
+        pipe.execute()
 
     def flush_logs(self):
         """ remove all logs for the task """
-        for key in self.redis.keys("{}*".format(self.logs_key)):
-            self.redis.delete(key)
-
-    def log_level_list_key(self, levelname):
-        return "{key}:{level}".format(key=self.logs_key, level=levelname)
+        levels = self.legacy_log_levels_in(self.redis)
+        self.redis.delete(*self.keys_for(self.uuid, levels)[1:])
 
     def log(self, msg, levelname, ttl=None, levelno=None):
         """ Logs a message into redis.
-            logs are organized inside redis as multiple keys
-
-            'task:$uuid:logs' is an hash with auto-incr integer keys (the index
-            is stored in 'task:$uuid:logs:index') and whose values is the log
-            message itself. For every loglevel, a list 'task:$uuid:logs:$level'
-            is created, storing hash indexes for the loglevel.
-            This way we preserve messages' order, and we have a nice way to get
-            all "DEBUG" message or "INFO" message by looking into the level lists.
-            We keep another sorted set in which we keep the mapping between
-            levelname and levelno to ease retrieving
-
-            Note: we can't store log messages in the sorted set directly as we
-            lost replicate messages with the same score (members in sorted sets
-            are unique while score can be replicated)
+            Messages are appended, in order, to the 'task:$uuid:log' list;
+            every entry is prefixed by the numeric level of the message
+            ("$levelno:$message"), so that the whole log is read with a
+            single LRANGE and filtered by level afterwards.
         """
         try:
             lno = getattr(logging, levelname) if levelno is None else levelno
         except AttributeError:
             raise ValueError("Invalid levelname {}".format(levelname))
 
-        index = self.redis.incr(self.logs_counter_key)
-        level_key = self.log_level_list_key(levelname)
-        self.redis.hset(self.logs_key, index, msg)
-        self.redis.rpush(level_key, index)
-        self.redis.zadd(self.logs_levels_key, lno, levelname)
+        self.log_many([(msg, lno)], ttl)
+
+    def log_many(self, entries, ttl=None):
+        """ appends many (message, levelno) entries in a single round trip """
+        entries = [self.encode_log(msg, levelno) for msg, levelno in entries]
+        if self.max_log_bytes:
+            entries = self._cap_logs(entries)
+            if not entries:
+                return
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.rpush(self.logs_key, *entries)
+        if self.max_log_bytes:
+            pipe.hincrby(self.key, 'log_bytes',
+                         sum(len(entry) for entry in entries))
         if ttl:
-            self.redis.expire(self.logs_counter_key, ttl)
-            self.redis.expire(level_key, ttl)
-            self.redis.expire(self.logs_key, ttl)
+            pipe.expire(self.logs_key, ttl)
+        pipe.execute()
+
+    def _cap_logs(self, entries):
+        """ the entries that fit in max_log_bytes. Once the limit is hit,
+            a marker is logged and following messages are discarded.
+            The size of the logs is read once, then tracked locally. """
+        if self._log_bytes is None:
+            self._log_bytes = -1 if 'log_truncated' in self else \
+                              int(self.get('log_bytes', 0))
+
+        kept = []
+        for entry in entries:
+            if self._log_bytes < 0:
+                break
+
+            if self._log_bytes + len(entry) > self.max_log_bytes:
+                self._log_bytes = -1
+                self['log_truncated'] = 'true'
+                kept.append(self.encode_log(
+                        "Log truncated: more than {} bytes"
+                        .format(self.max_log_bytes), logging.WARNING))
+                break
+
+            self._log_bytes += len(entry)
+            kept.append(entry)
+
+        return kept
+
+    @classmethod
+    def encode_log(cls, msg, levelno):
+        """ "$levelno:$message", or "z$levelno:$compressed_message" """
+        if cls.compress_threshold and len(msg) > cls.compress_threshold:
+            if isinstance(msg, unicode):
+                msg = msg.encode('utf-8')
+            return "z{}:{}".format(int(levelno), zlib.compress(msg))
+        return "{}:{}".format(int(levelno), msg)
+
+    @staticmethod
+    def decode_log(entry):
+        """ returns the (levelno, message) tuple for a log entry """
+        levelno, msg = entry.split(':', 1)
+        if levelno.startswith('z'):
+            return int(levelno[1:]), zlib.decompress(msg)
+        return int(levelno), msg
 
     def get_logs(self, level):
+        """ messages with level greater or equal to the given one:
+            if we ask for DEBUG, we get all levels,
+            if we ask for WARN, we get WARN, ERROR and CRITICAL """
+        return self.tail_logs(level)[0]
+
+    def tail_logs(self, level, since=0):
+        """ like get_logs, but only for the messages logged after the
+            first 'since' ones. Returns the messages and the cursor to get
+            the following ones """
         if not isinstance(level, int):
             level = getattr(logging, level)
 
-        # use the levelno as score to get the wanted levels.
-        # if we ask for DEBUG, we get all levels
-        # if we ask for WARN, we get WARN, ERROR and CRITICAL
-        levels = self.redis.zrangebyscore(self.logs_levels_key,
-                                     float(level),
-                                     float(logging.CRITICAL))
-
-        # get all hash keys in the selected log levels
-        msg_ids = []
-        for level in levels:
-            key = self.log_level_list_key(level)
-            msg_ids.extend([int(k) for k in self.redis.lrange(key, 0, -1)])
-
-        # now we have all the keys we are interested in so we can
-        # return the log levels in the right order.
-        if not msg_ids:
+        entries = self.redis.lrange(self.logs_key, since, -1)
+        if entries or self.redis.exists(self.logs_key):
+            logs = [self.decode_log(entry) for entry in entries]
+        else:
+            logs = self.legacy_logs(self.uuid, self.redis)[since:]
+
+        messages = [msg for levelno, msg in logs if levelno >= level]
+        return messages, since + len(logs)
+
+    @classmethod
+    def legacy_logs(cls, uuid, redis_client):
+        """ (levelno, message) of the logs written by older versions in
+            the 'task:$uuid:logs' hash, whose messages are listed by index
+            in the 'task:$uuid:logs:$LEVEL' lists, in order """
+        legacy_logs_key = cls.keys_for(uuid)[2]
+        if not redis_client.exists(legacy_logs_key):
+            return []
+
+        levels = redis_client.zrange('logs:levels', 0, -1, withscores=True)
+        pipe = redis_client.pipeline(transaction=False)
+        for levelname, levelno in levels:
+            pipe.lrange("{}:{}".format(legacy_logs_key, levelname), 0, -1)
+        levelnos = {}
+        for (levelname, levelno), indexes in zip(levels, pipe.execute()):
+            for index in indexes:
+                levelnos[int(index)] = int(levelno)
+        if not levelnos:
             return []
-        return self.redis.hmget(self.logs_key, sorted(msg_ids))
+
+        indexes = sorted(levelnos)
+        messages = redis_client.hmget(legacy_logs_key, indexes)
+        return [(levelnos[index], msg)
+                for index, msg in zip(indexes, messages) if msg is not None]
+
+    def progress(self, done, total=None, stage=None):
+        """ Reports the progress of the task: stored in the 'progress.done',
+            'progress.total' and 'progress.stage' fields and published as
+            a '$uuid.progress' event """
+        progress = dict(done=done)
+        if total is not None:
+            progress['total'] = total
+        if stage is not None:
+            progress['stage'] = stage
+
+        self.update({'progress.{}'.format(k): v
+                     for k, v in progress.iteritems()})
+        if self.publisher:
+            self.publisher("{}.progress".format(self.uuid),
+                           json.dumps(progress))
+
+    @property
+    def is_done(self):
+        return self.status in self.done_statuses
+
+    def cancel_requested(self):
+        """ whether the cancellation of the task has been requested;
+            always reads from redis, even for snapshots """
+        return bool(self.redis.hexists(self.key, 'cancel'))
 
     def __str__(self):
         return self.__repr__()
@@ -267,3 +730,456 @@ class TaskResponse(object):
                                                    self.status,
                                                    self.message)
 
+
+class TaskQueue(object):
+    """ A durable queue of task uuids stored in redis.
+        Every priority has its own lane, the 'tasks:queue:$priority' list.
+        Consumers always drain the high priority lane first, atomically
+        moving popped tasks on the 'tasks:queue:processing' list, and remove
+        them from there (ack) only when they are completed, so no task is
+        lost if the daemon dies while executing it.
+        Every push also leaves a token in 'tasks:queue:wakeup', a list
+        consumers block on while all the lanes are empty: the list is
+        trimmed to that single token, as tokens of tasks popped without
+        blocking are never consumed.
+    """
+
+    def __init__(self, redis_client, key='tasks:queue', coalesce=()):
+        self.redis = redis_client
+        self.key = key
+        self.processing_key = "{key}:processing".format(key=key)
+        self.wakeup_key = "{key}:wakeup".format(key=key)
+        self.coalesce_commands = frozenset(coalesce)
+
+    @classmethod
+    def from_settings(cls, redis_client, settings):
+        coalesce = settings.get('tasks.coalesce', '').split()
+        return cls(redis_client, coalesce=coalesce)
+
+    def family_key(self, task):
+        """ tasks running the same command with the same arguments, but
+            the instance id, belong to the same family """
+        args = sorted((k, v) for k, v in task.command_args.iteritems()
+                      if k != 'id')
+        digest = hashlib.sha1(repr(args)).hexdigest()
+        return "{key}:coalesce:{command}:{digest}".format(key=self.key,
+                                                         command=task.command,
+                                                         digest=digest)
+
+    def lane_key(self, priority):
+        return "{key}:{priority}".format(key=self.key, priority=priority)
+
+    def __len__(self):
+        return sum(self.stats().values())
+
+    def stats(self):
+        """ number of tasks waiting in every lane """
+        pipe = self.redis.pipeline(transaction=False)
+        for priority in taskpriority:
+            pipe.llen(self.lane_key(priority))
+        return dict(zip(taskpriority, pipe.execute()))
+
+    def push(self, task, front=False, pipeline=None):
+        """ mark the task as queued and enqueue it in the lane for its
+            priority in a single transaction. With front, the task is
+            popped before those already waiting (i.e. to requeue it).
+            If a (transactional) pipeline is given the commands are queued
+            on it and not executed """
+        priority = task.get('priority', taskpriority.NORMAL)
+        if priority not in taskpriority:
+            raise ValueError("Invalid priority {}".format(priority))
+
+        pipe = self.redis.pipeline() if pipeline is None else pipeline
+        task.update(dict(status=taskstatus.QUEUED,
+                         queued=datetime.datetime.now()), pipeline=pipe)
+        if front:
+            pipe.rpush(self.lane_key(priority), task.uuid)
+        else:
+            pipe.lpush(self.lane_key(priority), task.uuid)
+        pipe.lpush(self.wakeup_key, 1)
+        pipe.ltrim(self.wakeup_key, 0, 0)
+        if task.command in self.coalesce_commands:
+            pipe.hset(self.family_key(task), task.uuid,
+                      task.command_args.get('id', ''))
+        if pipeline is None:
+            pipe.execute()
+
+    def pop(self, timeout=0):
+        """ blocks up to timeout seconds waiting for a task.
+            Returns the uuid of the task with the highest priority or None """
+        while True:
+            for priority in taskpriority:
+                lane_key = self.lane_key(priority)
+                uuid = self.redis.rpoplpush(lane_key, self.processing_key)
+                while uuid and not self.redis.exists(Task.key_for(uuid)):
+                    # removed while waiting, i.e. by Task.flush
+                    self.ack(uuid)
+                    uuid = self.redis.rpoplpush(lane_key, self.processing_key)
+                if uuid:
+                    return uuid
+
+            if not self.redis.brpop(self.wakeup_key, timeout):
+                return None
+
+            # tokens of tasks already popped are useless
+            self.redis.delete(self.wakeup_key)
+
+    def ack(self, uuid):
+        self.redis.lrem(self.processing_key, 0, uuid)
+
+    def remove(self, task):
+        """ removes a task still waiting in the lanes.
+            Returns False if the task has already been popped """
+        pipe = self.redis.pipeline(transaction=False)
+        for priority in taskpriority:
+            pipe.lrem(self.lane_key(priority), 0, task.uuid)
+        if task.command in self.coalesce_commands:
+            pipe.hdel(self.family_key(task), task.uuid)
+        return any(pipe.execute()[:len(taskpriority)])
+
+    def waiting(self):
+        """ uuids of the waiting tasks, in the order they will be popped """
+        pipe = self.redis.pipeline(transaction=False)
+        for priority in taskpriority:
+            pipe.lrange(self.lane_key(priority), 0, -1)
+        # lanes are pushed on the left and popped from the right
+        return [uuid for lane in pipe.execute() for uuid in reversed(lane)]
+
+    def coalesce(self, task, keys_for=None, conflict=None):
+        """ Merges into the given task, which has just been popped, the
+            tasks of its family still waiting in the lanes that it covers:
+            those with the same instance id, or all of them if the task has
+            id 'all'. Merged tasks are removed from the lanes, with
+            'coalesced_into' pointing to the given task, and are completed
+            with it by complete_coalesced().
+            Merging moves a task ahead of those waiting before it: with
+            keys_for(command, args), returning the lock keys of a task,
+            and conflict(keys, other_keys), a task is merged only if it
+            does not conflict with any of them.
+            Returns the uuids of the merged tasks.
+        """
+        if task.command not in self.coalesce_commands:
+            return []
+
+        family_key = self.family_key(task)
+        task_id = task.command_args.get('id', '')
+        self.redis.hdel(family_key, task.uuid)
+        covered = set(uuid for uuid, id_ in
+                      self.redis.hgetall(family_key).iteritems()
+                      if task_id == 'all' or id_ == task_id)
+        if not covered:
+            return []
+
+        keys = {}
+
+        def lock_keys(uuids):
+            missing = [uuid for uuid in uuids if uuid not in keys]
+            for uuid, values in Task.load_many(missing,
+                                               redis_client=self.redis)\
+                                    .iteritems():
+                args = {k.replace('_arg.', ''): v
+                        for k, v in values.iteritems()
+                        if k.startswith('_arg.')}
+                keys[uuid] = keys_for(values.get('command', ''), args)
+            return [keys[uuid] for uuid in uuids if uuid in keys]
+
+        merged = []
+        ahead = []
+        for uuid in self.waiting():
+            if uuid not in covered:
+                ahead.append(uuid)
+                continue
+
+            if keys_for and conflict:
+                candidate = lock_keys([uuid])
+                if not candidate or any(conflict(candidate[0], other)
+                                        for other in lock_keys(ahead)):
+                    ahead.append(uuid)
+                    continue
+
+            pipe = self.redis.pipeline(transaction=False)
+            for priority in taskpriority:
+                pipe.lrem(self.lane_key(priority), 0, uuid)
+            pipe.hdel(family_key, uuid)
+            if not any(pipe.execute()[:-1]):
+                # already popped
+                continue
+
+            self.mark_coalesced(uuid, task.uuid)
+            merged.append(uuid)
+
+        return merged
+
+    def coalesced_key(self, uuid):
+        return "{key}:coalesced:{uuid}".format(key=self.key, uuid=uuid)
+
+    def mark_coalesced(self, uuid, into):
+        """ the task uuid has been merged into the task 'into': it keeps
+            its status until that one completes """
+        pipe = self.redis.pipeline()
+        pipe.hset(Task.key_for(uuid), 'coalesced_into', into)
+        pipe.sadd(self.coalesced_key(into), uuid)
+        pipe.execute()
+
+    def complete_coalesced(self, into):
+        """ copies the final status, result and completion time of the
+            task 'into' to the tasks merged into it.
+            Returns the uuids of the completed tasks """
+        key = self.coalesced_key(into)
+        uuids = self.redis.smembers(key)
+        if not uuids:
+            return []
+
+        status, result, finished = self.redis.hmget(Task.key_for(into),
+                                                    'status', 'result',
+                                                    'finished')
+        status = Task.decode_value(status) if status else taskstatus.ERROR
+        # result and finished are copied as they are stored
+        values = dict(status=Task.encode_value(status), result=result or '',
+                      finished=finished or
+                               Task.encode_value(datetime.datetime.now()))
+        pipe = self.redis.pipeline()
+        for uuid in uuids:
+            pipe.hmset(Task.key_for(uuid), values)
+            Task.index_status(pipe, uuid, status)
+        pipe.delete(key)
+        pipe.execute()
+        return list(uuids)
+
+    @property
+    def processing(self):
+        return self.redis.lrange(self.processing_key, 0, -1)
+
+    def requeue(self):
+        """ enqueue again tasks that have been popped but never acked,
+            and tasks whose delivery has been deferred.
+            Returns the list of the requeued uuids.
+        """
+        uuids = []
+        # most recently popped first: the oldest ends up in front
+        for uuid in self.processing:
+            task = Task(uuid=uuid, redis_client=self.redis, snapshot=True)
+            self.push(task, front=True)
+            self.ack(uuid)
+            uuids.append(uuid)
+
+        for uuid in Task.with_status(taskstatus.DEFERRED,
+                                     redis_client=self.redis):
+            task = Task(uuid=uuid, redis_client=self.redis, snapshot=True)
+            self.push(task)
+            uuids.append(uuid)
+
+        return uuids
+
+
+class TaskSchedule(object):
+    """ Tasks to be executed later, once or periodically, stored in redis.
+        Every schedule has a 'tasks:schedule:$id' hash with its settings
+        and the uuid of its next occurrence, a task in the SCHEDULED status
+        created in advance, and is scored in the 'tasks:scheduled' sorted
+        set by the time that occurrence is due.
+        Occurrences of periodic schedules are due every 'every' seconds;
+        every occurrence is delayed by a random time up to 'jitter' seconds,
+        and it is postponed while 'max_concurrency' previous occurrences
+        are still queued or running: these are kept in the
+        'tasks:schedule:$id:active' set.
+    """
+
+    # fields copied from an occurrence to the following one
+    copied_fields = ('command', 'priority', 'log_level')
+
+    def __init__(self, redis_client, key='tasks:scheduled'):
+        self.redis = redis_client
+        self.key = key
+
+    def schedule_key(self, id_):
+        return "tasks:schedule:{}".format(id_)
+
+    def active_key(self, id_):
+        return "tasks:schedule:{}:active".format(id_)
+
+    def __len__(self):
+        return self.redis.zcard(self.key)
+
+    def add(self, task, run_at, every=0, jitter=0, max_concurrency=0):
+        """ schedules the task, the first occurrence of the schedule, to be
+            queued at the 'run_at' timestamp. Returns the schedule id """
+        id_ = task.uuid
+        pipe = self.redis.pipeline()
+        pipe.hmset(self.schedule_key(id_),
+                   dict(every=every, jitter=jitter,
+                        max_concurrency=max_concurrency))
+        self._schedule(pipe, id_, task, run_at, jitter)
+        pipe.execute()
+        return id_
+
+    def _schedule(self, pipe, id_, task, due, jitter):
+        task.update(dict(status=taskstatus.SCHEDULED, schedule=id_,
+                         run_at=datetime.datetime.fromtimestamp(due)),
+                    pipeline=pipe)
+        pipe.hmset(self.schedule_key(id_), dict(next=task.uuid, due=repr(due)))
+        pipe.zadd(self.key, due + random.uniform(0, jitter), id_)
+
+    def remove(self, id_):
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.key, id_)
+        pipe.delete(self.schedule_key(id_), self.active_key(id_))
+        pipe.execute()
+
+    def cancel(self, id_):
+        """ removes the schedule and cancels its next occurrence.
+            Returns False if there is no such schedule """
+        next_ = self.redis.hget(self.schedule_key(id_), 'next')
+        if next_ is None:
+            return False
+
+        self.remove(id_)
+        try:
+            task = Task.retrieve(next_, redis_client=self.redis,
+                                 snapshot=True)
+        except TaskNotFoundError:
+            return True
+
+        if task.status == taskstatus.SCHEDULED:
+            task.update(status=taskstatus.CANCELLED,
+                        finished=datetime.datetime.now(),
+                        result='Task cancelled')
+        return True
+
+    def due(self, limit, now=None):
+        """ ids of at most 'limit' schedules with an occurrence due """
+        now = time.time() if now is None else now
+        return self.redis.zrangebyscore(self.key, "-inf", now,
+                                        start=0, num=limit)
+
+    def active(self, id_):
+        """ uuids of the queued occurrences of the schedule not done yet """
+        key = self.active_key(id_)
+        uuids = list(self.redis.smembers(key))
+        if not uuids:
+            return []
+
+        pipe = self.redis.pipeline(transaction=False)
+        for uuid in uuids:
+            pipe.hget(Task.key_for(uuid), 'status')
+        statuses = [Task.decode_value(s) if s else None
+                    for s in pipe.execute()]
+        done = [uuid for uuid, status in zip(uuids, statuses)
+                if status is None or status in Task.done_statuses]
+        if done:
+            self.redis.srem(key, *done)
+        return [uuid for uuid in uuids if uuid not in done]
+
+    def promote(self, id_, queue, now=None, retry=1):
+        """ Pushes the due occurrence of the schedule on the queue and, for
+            periodic schedules, creates the next one. Occurrences exceeding
+            the max concurrency are postponed by 'retry' seconds.
+            Returns the uuid of the queued task, or None.
+        """
+        now = time.time() if now is None else now
+        if not self.redis.zrem(self.key, id_):
+            # promoted by someone else
+            return None
+
+        settings = self.redis.hgetall(self.schedule_key(id_))
+        if not settings:
+            return None
+
+        every = float(settings.get('every', 0))
+        jitter = float(settings.get('jitter', 0))
+        max_concurrency = int(settings.get('max_concurrency', 0))
+        try:
+            task = Task.retrieve(settings['next'], redis_client=self.redis,
+                                 snapshot=True)
+        except (KeyError, TaskNotFoundError):
+            task = None
+
+        if task is None or task.status != taskstatus.SCHEDULED:
+            # cancelled or removed
+            self.remove(id_)
+            return None
+
+        if max_concurrency and len(self.active(id_)) >= max_concurrency:
+            self.redis.zadd(self.key, now + retry, id_)
+            return None
+
+        if not every:
+            self.remove(id_)
+            queue.push(task)
+            return task.uuid
+
+        due = float(settings['due']) + every
+        if due <= now:
+            # skip the occurrences missed while nobody was promoting
+            due += every * (int((now - due) // every) + 1)
+        fields = {k: v for k, v in task.iteritems()
+                  if k in self.copied_fields or k.startswith('_arg.')}
+        following = Task(redis_client=self.redis,
+                         requested=datetime.datetime.now(), **fields)
+        pipe = self.redis.pipeline()
+        self._schedule(pipe, id_, following, due, jitter)
+        pipe.sadd(self.active_key(id_), task.uuid)
+        pipe.execute()
+        queue.push(task)
+        return task.uuid
+
+
+class TaskStats(object):
+    """ Latency histograms of the phases of tasks (i.e. queue wait,
+        execution, commit), per command, stored in redis.
+        Every command has a 'stats:timing:$command' hash, with the
+        '$phase:count' and '$phase:sum_ms' fields and a '$phase:$bound'
+        field counting the durations up to $bound milliseconds (and
+        above the previous bound), or '$phase:inf' for the longer ones.
+    """
+
+    bounds = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000,
+              300000)
+
+    def __init__(self, redis_client, key='stats:timing'):
+        self.redis = redis_client
+        self.key = key
+
+    def command_key(self, command):
+        return "{key}:{command}".format(key=self.key, command=command)
+
+    def bucket(self, ms):
+        for bound in self.bounds:
+            if ms <= bound:
+                return str(bound)
+        return 'inf'
+
+    def record(self, command, timings):
+        """ add the timings (phase => seconds) of a task running command
+            to the histograms with a single pipeline """
+        key = self.command_key(command)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sadd(self.key, command)
+        for phase, seconds in timings.iteritems():
+            ms = int(seconds * 1000)
+            pipe.hincrby(key, "{}:{}".format(phase, self.bucket(ms)), 1)
+            pipe.hincrby(key, "{}:count".format(phase), 1)
+            pipe.hincrby(key, "{}:sum_ms".format(phase), ms)
+        pipe.execute()
+
+    def histograms(self):
+        """ command => phase => {'count': .., 'sum_ms': ..,
+                                 'buckets': {bound: count}} """
+        commands = sorted(self.redis.smembers(self.key))
+        pipe = self.redis.pipeline(transaction=False)
+        for command in commands:
+            pipe.hgetall(self.command_key(command))
+
+        res = {}
+        for command, values in zip(commands, pipe.execute()):
+            phases = res[command] = {}
+            for field, value in values.iteritems():
+                phase, name = field.rsplit(':', 1)
+                stats = phases.setdefault(phase, dict(count=0, sum_ms=0,
+                                                      buckets={}))
+                if name in ('count', 'sum_ms'):
+                    stats[name] = int(value)
+                else:
+                    stats['buckets'][name] = int(value)
+
+        return res
@@ -0,0 +1,39 @@
+"""Add tasks_archive table
+
+Revision ID: 1f8e3c6a2d4b
+Revises: 535ddcd39cad
+Create Date: 2012-06-04 11:20:37.401220
+
+"""
+
+# downgrade revision identifier, used by Alembic.
+revision = '1f8e3c6a2d4b'
+down_revision = '535ddcd39cad'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(u'tasks_archive',
+                    sa.Column(u'uuid', sa.Unicode(32), primary_key=True),
+                    sa.Column(u'command', sa.Unicode(128), nullable=False),
+                    sa.Column(u'status', sa.Unicode(16), nullable=False),
+                    sa.Column(u'requested', sa.DateTime()),
+                    sa.Column(u'started', sa.DateTime()),
+                    sa.Column(u'finished', sa.DateTime()),
+                    sa.Column(u'fields', sa.UnicodeText(), nullable=False),
+                    sa.Column(u'logs', sa.UnicodeText(), nullable=False),
+                    mysql_engine=u'InnoDB')
+    op.create_index(u'ix_tasks_archive_command', u'tasks_archive',
+                    [u'command'])
+    op.create_index(u'ix_tasks_archive_status', u'tasks_archive',
+                    [u'status'])
+    op.create_index(u'ix_tasks_archive_requested', u'tasks_archive',
+                    [u'requested'])
+    op.create_index(u'ix_tasks_archive_finished', u'tasks_archive',
+                    [u'finished'])
+
+
+def downgrade():
+    op.drop_table(u'tasks_archive')
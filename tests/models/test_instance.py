@@ -23,6 +23,7 @@ from aybu.manager.models import (Environment,
 from . test_base import ManagerModelsTestsBase
 from aybu.manager.exc import OperationalError, NotSupported
 import os
+import tarfile
 
 
 class InstanceTests(ManagerModelsTestsBase):
@@ -36,8 +37,13 @@ class InstanceTests(ManagerModelsTestsBase):
                 .filter(Theme.name == 'uffizi').one()
         env = Environment.create(self.session, 'testenv',
                                  config=self.config)
-        instance = Instance.deploy(self.session, 'www.example.com', owner,
-                                   env, owner, theme=theme)
+        progress = []
+        instance = Instance.deploy(
+                        self.session, 'www.example.com', owner, env, owner,
+                        theme=theme,
+                        progress=lambda *args: progress.append(args))
+        self.assertEqual(progress[0], (0, 6, 'structure'))
+        self.assertEqual(progress[-1], (6, 6, 'done'))
 
         # vassal config is created only upon session commit
         self.assertFalse(os.path.exists(instance.paths.vassal_config))
@@ -107,10 +113,20 @@ class InstanceTests(ManagerModelsTestsBase):
         instance.upgrade_schema('head')
 
         # create an archive
-        instance.archive(archive_name='test')
+        progress = []
+        instance.archive(archive_name='test',
+                         progress=lambda *args: progress.append(args))
+        self.assertEqual([p[2] for p in progress],
+                         ['dump', 'copy', 'compress', 'done'])
         p = os.path.join(instance.environment.paths.archives,
                          "test.tar.gz")
         self.assertTrue(os.path.exists(p))
+        p = instance.archive(archive_name='test-throttled',
+                             throttle='nice -n 10')
+        self.assertTrue(os.path.exists(p))
+        with tarfile.open(p) as archive:
+            self.assertFalse([n for n in archive.getnames()
+                              if n.endswith('.pyc')])
 
         # test restore and delete
         with self.assertRaises(OperationalError):
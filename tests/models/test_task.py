@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import datetime
+import json
+import logging
+from aybu.manager.models import ArchivedTask
+from . test_base import ManagerModelsTestsBase
+
+
+class ArchivedTaskTests(ManagerModelsTestsBase):
+
+    def archive(self, uuid, requested):
+        task = ArchivedTask(uuid=uuid, command=u'instance.reload',
+                            status=u'FINISHED', requested=requested,
+                            fields=json.dumps(dict(command='instance.reload',
+                                                   status='FINISHED')),
+                            logs=json.dumps([(logging.DEBUG, 'debug'),
+                                             (logging.ERROR, 'error')]))
+        self.session.add(task)
+        return task
+
+    def test_to_dict(self):
+        task = self.archive(u'a', datetime.datetime(2012, 6, 1))
+        self.assertEqual(task.to_dict(), dict(command='instance.reload',
+                                              status='FINISHED',
+                                              archived=True))
+
+    def test_get_logs(self):
+        task = self.archive(u'a', datetime.datetime(2012, 6, 1))
+        self.assertEqual(task.get_logs('DEBUG'), ['debug', 'error'])
+        self.assertEqual(task.get_logs('WARNING'), ['error'])
+
+    def test_page(self):
+        for day in xrange(1, 6):
+            self.archive(unicode(day), datetime.datetime(2012, 6, day))
+        self.session.flush()
+
+        page = ArchivedTask.page(self.session, 2)
+        self.assertEqual([t.uuid for t in page], [u'5', u'4'])
+        page = ArchivedTask.page(self.session, 2, page[-1].requested)
+        self.assertEqual([t.uuid for t in page], [u'3', u'2'])
+        page = ArchivedTask.page(self.session, 2, page[-1].requested)
+        self.assertEqual([t.uuid for t in page], [u'1'])
+
+    def test_with_status(self):
+        self.archive(u'a', datetime.datetime(2012, 6, 1))
+        failed = self.archive(u'b', datetime.datetime(2012, 6, 2))
+        failed.status = u'FAILED'
+        self.session.flush()
+
+        self.assertEqual([t.uuid for t in
+                          ArchivedTask.with_status(self.session, u'FAILED')],
+                         [u'b'])
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from aybu.manager.exc import ParamsError
+from aybu.manager.rest.request import check_task
+from pyramid import testing
+from sqlalchemy.orm.exc import NoResultFound
+import mock
+import unittest
+
+
+class TestInstancesViews(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        super(TestInstancesViews, self).setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+        super(TestInstancesViews, self).tearDown()
+
+    def get_request(self, *args, **kwargs):
+        req = testing.DummyRequest(*args, **kwargs)
+        req.db_session = mock.Mock()
+        submitted = []
+
+        def submit_task(command, verbose=False, **data):
+            # what Request.submit_task validates before enqueueing
+            check_task(command, [k for k, v in data.iteritems()
+                                 if v is not None])
+            submitted.append((command, verbose, data))
+
+        req.submit_task = submit_task
+        return testing.DummyResource(), req, submitted
+
+    @mock.patch('aybu.manager.rest.views.instances.validate_hostname',
+                lambda domain: domain)
+    @mock.patch('aybu.manager.rest.views.instances.check_domain_not_used')
+    @mock.patch('aybu.manager.rest.views.instances.Theme')
+    @mock.patch('aybu.manager.rest.views.instances.Environment')
+    @mock.patch('aybu.manager.rest.views.instances.User')
+    @mock.patch('aybu.manager.rest.views.instances.Instance')
+    def test_deploy(self, imock, umock, emock, tmock, cmock):
+        from aybu.manager.rest.views.instances import deploy
+        imock.get_by_domain.side_effect = NoResultFound()
+        ctx, req, submitted = self.get_request()
+        req.params.update(domain='www.example.com',
+                          owner_email='owner@example.com',
+                          environment_name='default',
+                          verbose='1')
+        deploy(ctx, req)
+
+        command, verbose, data = submitted[0]
+        self.assertEqual(command, 'instance.deploy')
+        self.assertTrue(verbose)
+        self.assertNotIn('verbose', data)
+        self.assertEqual(data['technical_contact_email'], 'owner@example.com')
+
+    def test_check_task(self):
+        check_task('instance.reload', ['id', 'force'])
+        with self.assertRaises(ParamsError):
+            check_task('instance.unknown', ['id'])
+        with self.assertRaises(ParamsError):
+            check_task('instance.deploy', ['domain', 'verbose'])
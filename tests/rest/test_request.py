@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from aybu.manager.exc import ParamsError
+from aybu.manager.rest.request import Request
+import unittest
+
+
+class TestTaskSchedule(unittest.TestCase):
+
+    def schedule(self, **headers):
+        headers = {'X-Task-{}'.format(k.replace('_', '-')): v
+                   for k, v in headers.iteritems()}
+        return Request.blank('/', headers=headers).task_schedule()
+
+    def test_not_scheduled(self):
+        self.assertIsNone(self.schedule(Jitter='10'))
+
+    def test_schedule(self):
+        schedule = self.schedule(Run_At='1700000000', Every='3600',
+                                 Jitter='60', Max_Concurrency='1')
+        self.assertEqual(schedule, dict(run_at=1700000000.0, every=3600.0,
+                                        jitter=60.0, max_concurrency=1))
+
+    def test_zero_values(self):
+        schedule = self.schedule(Every='60', Jitter='0', Max_Concurrency='0')
+        self.assertEqual(schedule['jitter'], 0)
+        self.assertEqual(schedule['max_concurrency'], 0)
+
+    def test_invalid_values(self):
+        for headers in (dict(Run_At='nan'), dict(Run_At='inf'),
+                        dict(Run_At='-1'), dict(Run_At='tomorrow'),
+                        dict(Every='0'), dict(Every='-inf'),
+                        dict(Every='NaN'), dict(Every='60', Jitter='inf'),
+                        dict(Every='60', Jitter='-1'),
+                        dict(Every='60', Max_Concurrency='-1')):
+            with self.assertRaises(ParamsError):
+                self.schedule(**headers)
+
+
+class TestTaskPriority(unittest.TestCase):
+
+    def test_header(self):
+        request = Request.blank('/', headers={'X-Task-Priority': ' High'})
+        self.assertEqual(request.task_priority('instance.reload'), 'high')
+
+    def test_invalid_header(self):
+        request = Request.blank('/', headers={'X-Task-Priority': 'urgent'})
+        with self.assertRaises(ParamsError):
+            request.task_priority('instance.reload')
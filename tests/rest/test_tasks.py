@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from aybu.manager.task import taskstatus
+import mock
+import unittest
+
+
+class TestTaskEvents(unittest.TestCase):
+
+    @mock.patch('aybu.manager.rest.views.tasks.wait_message')
+    def test_stream_lost_finished(self, wmock):
+        """ the stream ends at the first heartbeat after the end of the
+            task even if the 'finished' message never arrives """
+        from aybu.manager.rest.views.tasks import stream_events
+        wmock.return_value = []
+        task = mock.MagicMock()
+        type(task).is_done = mock.PropertyMock(side_effect=[False, False,
+                                                            True])
+        task.status = taskstatus.FINISHED
+        task.get.return_value = ''
+        socket = mock.Mock()
+
+        events = list(stream_events(task, socket, 600, 15))
+
+        self.assertEqual(wmock.call_count, 2)
+        self.assertEqual(events[1], ": keepalive\n\n")
+        self.assertTrue(events[-1].startswith("event: finished\n"))
+        self.assertIn(taskstatus.FINISHED, events[-1])
+        socket.close.assert_called_once_with()
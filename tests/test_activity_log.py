@@ -63,6 +63,14 @@ class ActivityLogTests(unittest.TestCase):
             al.add(create, file_)
         self.assertTrue(os.path.exists(file_))
 
+    def test_timings(self):
+        al = ActivityLog()
+        al.add(mkdir, os.path.join(self.tempdir, 'dir'))
+        al.add(create, os.path.join(self.tempdir, 'dir', 'test.txt'))
+        al.commit()
+        self.assertEqual(al.timings.keys(), ['fs'])
+        self.assertTrue(al.timings['fs'] >= 0)
+
     def test_transaction_status(self):
         al = ActivityLog(autobegin=False)
         with self.assertRaises(TransactionError):
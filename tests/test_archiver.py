@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import logging
+import unittest
+from aybu.manager.daemon.archiver import TaskArchiver
+from aybu.manager.task import Task
+
+
+class TaskArchiverTests(unittest.TestCase):
+
+    def test_archived_task_not_utf8(self):
+        archiver = TaskArchiver({}, None)
+        fields = dict(command='instance.reload', status='FINISHED',
+                      result=Task.encode_value('caf\xe8'))
+        entries = [Task.encode_log('caf\xe8', logging.INFO)]
+        task = archiver.archived_task('a', fields, 2, entries)
+        self.assertEqual(json.loads(task.fields)['result'], u'caf�')
+        logs = json.loads(task.logs)
+        self.assertEqual(logs[0][0], logging.WARNING)
+        self.assertEqual(logs[1], [logging.INFO, u'caf�'])
+
+    def test_minimal_archived_task(self):
+        archiver = TaskArchiver({}, None)
+        task = archiver.minimal_archived_task('a', dict(
+                                                command='instance.reload',
+                                                status='FINISHED'))
+        self.assertEqual(task.to_dict(), dict(command='instance.reload',
+                                              status='FINISHED',
+                                              archived=True))
+        self.assertEqual(task.get_logs('DEBUG'), [])
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import unittest
+from aybu.manager.daemon.commands import (Command,
+                                          load_commands)
+from aybu.manager.exc import ParamsError
+
+
+class CommandRegistryTests(unittest.TestCase):
+
+    def test_load_commands(self):
+        commands = load_commands()
+        self.assertIn('instance.deploy', commands)
+        self.assertIn('redirect.update', commands)
+        self.assertNotIn('instance.fan_out', commands)
+        self.assertNotIn('instance.log', commands)
+        reload_ = commands['instance.reload']
+        self.assertEqual(reload_.args, ('id', 'force', 'kill'))
+        self.assertEqual(reload_.required, ('id',))
+
+    def test_check_args(self):
+        def command(session, task, id, force=False):
+            pass
+
+        command = Command.from_function('instance.test', command)
+        command.check_args(['id'])
+        command.check_args(['id', 'force'])
+        with self.assertRaises(ParamsError):
+            command.check_args(['force'])
+        with self.assertRaises(ParamsError):
+            command.check_args(['id', 'domain'])
+
+    def test_invalid_signature(self):
+        def helper(instance):
+            pass
+
+        def variadic(session, task, **kwargs):
+            pass
+
+        self.assertIsNone(Command.from_function('instance.helper', helper))
+        self.assertIsNone(Command.from_function('instance.variadic',
+                                                variadic))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import subprocess
+import time
+import unittest
+from aybu.manager.activity_log.process import (check_limits,
+                                               clear_limits,
+                                               run,
+                                               set_limits)
+from aybu.manager.exc import (TaskCancelledError,
+                              TaskTimeoutError)
+
+
+class ProcessTests(unittest.TestCase):
+
+    def tearDown(self):
+        clear_limits()
+
+    def test_run(self):
+        self.assertEqual(run(['true']), 0)
+        self.assertEqual(run(['echo', 'hello'], capture=True), 'hello\n')
+        with self.assertRaises(subprocess.CalledProcessError):
+            run(['false'])
+
+    def test_timeout(self):
+        set_limits(deadline=time.time() + 0.2)
+        start = time.time()
+        with self.assertRaises(TaskTimeoutError):
+            run(['sleep', '10'], poll_interval=0.05)
+        self.assertLess(time.time() - start, 5)
+        with self.assertRaises(TaskTimeoutError):
+            check_limits()
+
+    def test_cancel(self):
+        cancelled = []
+        set_limits(cancelled=lambda: bool(cancelled))
+        check_limits()
+        cancelled.append(True)
+        with self.assertRaises(TaskCancelledError):
+            run(['sleep', '10'], capture=True, poll_interval=0.05)
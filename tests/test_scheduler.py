@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import unittest
+from aybu.manager.daemon.scheduler import (TaskScheduler,
+                                           keys_conflict,
+                                           task_keys,
+                                           EXCLUSIVE,
+                                           SHARED)
+
+
+class TaskSchedulerTests(unittest.TestCase):
+
+    def test_task_keys(self):
+        self.assertEqual(task_keys('instance.reload', dict(id='1')),
+                         frozenset(['instance:1']))
+        self.assertEqual(task_keys('alias.create',
+                                   dict(domain='www.example.com',
+                                        instance_id='1')),
+                         frozenset(['instance:1', 'domain:www.example.com']))
+        self.assertEqual(task_keys('instance.reload', dict(id='all')),
+                         EXCLUSIVE)
+        self.assertEqual(task_keys('environment.rewrite', dict(name='test')),
+                         EXCLUSIVE)
+        self.assertEqual(task_keys('instance.kill', dict()), EXCLUSIVE)
+        self.assertEqual(task_keys('instance.backup', dict()), EXCLUSIVE)
+
+    def test_disjoint_keys(self):
+        scheduler = TaskScheduler()
+        scheduler.submit('a', task_keys('instance.reload', dict(id='1')))
+        scheduler.submit('b', task_keys('instance.reload', dict(id='2')))
+        self.assertEqual(scheduler.pop_ready(), 'a')
+        self.assertEqual(scheduler.pop_ready(), 'b')
+        self.assertEqual(scheduler.pop_ready(), None)
+
+    def test_same_keys_are_serialized(self):
+        scheduler = TaskScheduler()
+        scheduler.submit('a', task_keys('instance.change_domain',
+                                        dict(id='1',
+                                             domain='new.example.com')))
+        scheduler.submit('b', task_keys('alias.create',
+                                        dict(domain='alias.example.com',
+                                             instance_id='1')))
+        scheduler.submit('c', task_keys('instance.reload', dict(id='2')))
+        self.assertEqual(scheduler.pop_ready(), 'a')
+        self.assertEqual(scheduler.pop_ready(), 'c')
+        self.assertEqual(scheduler.pop_ready(), None)
+        scheduler.done('a')
+        self.assertEqual(scheduler.pop_ready(), 'b')
+
+    def test_exclusive(self):
+        scheduler = TaskScheduler()
+        scheduler.submit('a', task_keys('instance.reload', dict(id='1')))
+        scheduler.submit('b', task_keys('instance.rewrite', dict(id='all')))
+        scheduler.submit('c', task_keys('instance.reload', dict(id='2')))
+        self.assertEqual(scheduler.pop_ready(), 'a')
+        # 'c' must not overtake the exclusive task
+        self.assertEqual(scheduler.pop_ready(), None)
+        scheduler.done('a')
+        self.assertEqual(scheduler.pop_ready(), 'b')
+        self.assertEqual(scheduler.pop_ready(), None)
+        scheduler.done('b')
+        self.assertEqual(scheduler.pop_ready(), 'c')
+
+    def test_keys_conflict(self):
+        one = task_keys('instance.reload', dict(id='1'))
+        two = task_keys('instance.reload', dict(id='2'))
+        self.assertTrue(keys_conflict(one, one))
+        self.assertFalse(keys_conflict(one, two))
+        self.assertTrue(keys_conflict(one, EXCLUSIVE))
+        self.assertTrue(keys_conflict(EXCLUSIVE, two))
+
+    def test_conflicts_after(self):
+        reload_ = task_keys('instance.reload', dict(id='1'))
+        scheduler = TaskScheduler()
+        scheduler.submit('a', reload_)
+        scheduler.submit('b', task_keys('instance.reload', dict(id='2')))
+        # a later reload of instance 1 can be merged into 'a'...
+        self.assertFalse(scheduler.conflicts_after('a', reload_))
+        scheduler.submit('c', task_keys('instance.change_domain',
+                                        dict(id='1', domain='example.com')))
+        # ...but not once a change on the same instance is waiting after it
+        self.assertTrue(scheduler.conflicts_after('a', reload_))
+        self.assertFalse(scheduler.conflicts_after('c', reload_))
+
+    def test_backup_shared_locks(self):
+        backup = task_keys('instance.backup', dict(ids='1 2'))
+        self.assertEqual(backup, frozenset(['instance:1' + SHARED,
+                                            'instance:2' + SHARED]))
+        self.assertFalse(keys_conflict(backup, backup))
+        self.assertTrue(keys_conflict(backup, EXCLUSIVE))
+        for command in ('delete', 'change_domain', 'restore', 'archive'):
+            keys = task_keys('instance.{}'.format(command), dict(id='2'))
+            self.assertTrue(keys_conflict(backup, keys))
+            self.assertTrue(keys_conflict(keys, backup))
+        self.assertFalse(keys_conflict(backup, task_keys('instance.delete',
+                                                         dict(id='3'))))
+
+    def test_backup_excludes_changes(self):
+        scheduler = TaskScheduler()
+        scheduler.submit('a', task_keys('instance.backup', dict(ids='1 2')))
+        scheduler.submit('b', task_keys('instance.backup', dict(ids='2')))
+        scheduler.submit('c', task_keys('instance.delete', dict(id='2')))
+        scheduler.submit('d', task_keys('instance.delete', dict(id='3')))
+        self.assertEqual(scheduler.pop_ready(), 'a')
+        self.assertEqual(scheduler.pop_ready(), 'b')
+        # the instance cannot be deleted while it is being archived
+        self.assertEqual(scheduler.pop_ready(), 'd')
+        self.assertEqual(scheduler.pop_ready(), None)
+        scheduler.done('a')
+        self.assertEqual(scheduler.pop_ready(), None)
+        scheduler.done('b')
+        self.assertEqual(scheduler.pop_ready(), 'c')
+        # nor archived while it is being deleted
+        scheduler.submit('e', task_keys('instance.backup', dict(ids='2')))
+        self.assertEqual(scheduler.pop_ready(), None)
+        scheduler.done('c')
+        self.assertEqual(scheduler.pop_ready(), 'e')
+
+    def test_alias_and_redirect_lock_their_instance(self):
+        change = task_keys('instance.change_domain',
+                           dict(id='1', domain='new.example.com'))
+        for command, args in (
+                ('alias.delete', dict(domain='alias.example.com',
+                                      owner_id='1')),
+                ('alias.update', dict(domain='alias.example.com',
+                                      new_domain='other.example.com',
+                                      owner_id='1')),
+                ('alias.update', dict(domain='alias.example.com',
+                                      instance_id='2', owner_id='1')),
+                ('redirect.delete', dict(source='redir.example.com',
+                                         owner_id='1')),
+                ('redirect.update', dict(source='redir.example.com',
+                                         http_code='302', owner_id='1'))):
+            keys = task_keys(command, args)
+            self.assertIn('instance:1', keys)
+            self.assertTrue(keys_conflict(keys, change))
+
+        # moving an alias locks both the old and the new instance
+        keys = task_keys('alias.update', dict(domain='alias.example.com',
+                                              instance_id='2', owner_id='1'))
+        self.assertTrue(keys_conflict(keys, task_keys('instance.rewrite',
+                                                      dict(id='2'))))
+
+    def test_alias_waits_for_its_instance(self):
+        scheduler = TaskScheduler()
+        scheduler.submit('a', task_keys('instance.change_domain',
+                                        dict(id='1',
+                                             domain='new.example.com')))
+        scheduler.submit('b', task_keys('alias.delete',
+                                        dict(domain='alias.example.com',
+                                             owner_id='1')))
+        self.assertEqual(scheduler.pop_ready(), 'a')
+        self.assertEqual(scheduler.pop_ready(), None)
+        scheduler.done('a')
+        self.assertEqual(scheduler.pop_ready(), 'b')
+
+    def test_blocked(self):
+        scheduler = TaskScheduler()
+        scheduler.submit('a', task_keys('instance.reload', dict(id='1')))
+        self.assertFalse(scheduler.blocked)
+        scheduler.submit('b', task_keys('instance.migrate',
+                                        dict(id='all', revision='head')))
+        self.assertTrue(scheduler.blocked)
+        self.assertEqual(scheduler.pop_ready(), 'a')
+        scheduler.done('a')
+        self.assertEqual(scheduler.pop_ready(), 'b')
+        # running
+        self.assertTrue(scheduler.blocked)
+        scheduler.done('b')
+        self.assertFalse(scheduler.blocked)
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright 2010-2012 Asidev s.r.l.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import datetime
+import logging
+import os
+import unittest
+from paste.deploy.loadwsgi import appconfig
+from aybu.manager.daemon.scheduler import (keys_conflict,
+                                           task_keys)
+from aybu.manager.task import (Task,
+                              TaskQueue,
+                              TaskSchedule,
+                              redis_client_from_settings,
+                              taskstatus)
+
+
+class TaskEncodingTests(unittest.TestCase):
+
+    def test_log_entries(self):
+        entry = Task.encode_log('a: message', logging.INFO)
+        self.assertEqual(entry, '20:a: message')
+        self.assertEqual(Task.decode_log(entry), (logging.INFO, 'a: message'))
+
+    def test_compressed_log_entries(self):
+        msg = 'x' * (Task.compress_threshold + 1)
+        entry = Task.encode_log(msg, logging.ERROR)
+        self.assertTrue(entry.startswith('z40:'))
+        self.assertTrue(len(entry) < len(msg))
+        self.assertEqual(Task.decode_log(entry), (logging.ERROR, msg))
+
+    def test_values(self):
+        self.assertEqual(Task.encode_value(1), '1')
+        self.assertEqual(Task.decode_value('short'), 'short')
+        value = 'y' * (Task.compress_threshold + 1)
+        encoded = Task.encode_value(value)
+        self.assertTrue(encoded.startswith(Task.compressed_marker))
+        self.assertEqual(Task.decode_value(encoded), value)
+
+
+class RedisTestsBase(unittest.TestCase):
+    """ tests using the redis server configured in tests.ini: its database
+        is flushed before and after every test """
+
+    @classmethod
+    def setUpClass(cls):
+        here = os.path.dirname(os.path.realpath(__file__))
+        uri = 'config:' + os.path.join(here, "..", "tests.ini")
+        cls.settings = appconfig(uri, 'aybu-manager')
+
+    def setUp(self):
+        self.redis = redis_client_from_settings(self.settings)
+        self.redis.flushdb()
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def task(self, command, priority='normal', **args):
+        args = {'_arg.{}'.format(k): v for k, v in args.iteritems()}
+        return Task(redis_client=self.redis,
+                    requested=datetime.datetime.now(), command=command,
+                    priority=priority, **args)
+
+    def retrieve(self, uuid):
+        return Task.retrieve(uuid, redis_client=self.redis, snapshot=True)
+
+
+class TaskQueueCoalesceTests(RedisTestsBase):
+
+    def setUp(self):
+        super(TaskQueueCoalesceTests, self).setUp()
+        self.queue = TaskQueue(self.redis, coalesce=['instance.reload'])
+
+    def push(self, command, **args):
+        task = self.task(command, **args)
+        self.queue.push(task)
+        return task
+
+    def coalesce(self):
+        popped = self.retrieve(self.queue.pop())
+        return popped, self.queue.coalesce(popped, task_keys, keys_conflict)
+
+    def test_merge(self):
+        first = self.push('instance.reload', id='1')
+        second = self.push('instance.reload', id='1')
+        other = self.push('instance.reload', id='2')
+        popped, merged = self.coalesce()
+        self.assertEqual(popped.uuid, first.uuid)
+        self.assertEqual(merged, [second.uuid])
+        self.assertEqual(self.queue.waiting(), [other.uuid])
+        second = self.retrieve(second.uuid)
+        self.assertEqual(second.status, taskstatus.QUEUED)
+        self.assertEqual(second['coalesced_into'], first.uuid)
+
+    def test_complete_merged(self):
+        first = self.push('instance.reload', id='1')
+        second = self.push('instance.reload', id='1')
+        popped, merged = self.coalesce()
+        popped.update(status=taskstatus.FAILED, result='Error')
+        self.assertEqual(self.queue.complete_coalesced(first.uuid),
+                         [second.uuid])
+        second = self.retrieve(second.uuid)
+        self.assertEqual(second.status, taskstatus.FAILED)
+        self.assertEqual(second['result'], 'Error')
+        self.assertIn(second.uuid,
+                      Task.with_status(taskstatus.FAILED,
+                                       redis_client=self.redis))
+        self.assertEqual(self.queue.complete_coalesced(first.uuid), [])
+
+    def test_merge_all(self):
+        self.push('instance.reload', id='all')
+        one = self.push('instance.reload', id='1')
+        two = self.push('instance.reload', id='2')
+        popped, merged = self.coalesce()
+        self.assertEqual(sorted(merged), sorted([one.uuid, two.uuid]))
+        self.assertEqual(self.queue.waiting(), [])
+
+    def test_merge_keeps_order(self):
+        self.push('instance.reload', id='1')
+        change = self.push('instance.change_domain', id='1',
+                           domain='www.example.com')
+        again = self.push('instance.reload', id='1')
+        other = self.push('instance.reload', id='2')
+        popped, merged = self.coalesce()
+        # the second reload must run after the change of domain
+        self.assertEqual(merged, [])
+        self.assertEqual(self.queue.waiting(),
+                         [change.uuid, again.uuid, other.uuid])
+        self.assertEqual(self.retrieve(again.uuid).status, taskstatus.QUEUED)
+
+
+class TaskRemoveTests(RedisTestsBase):
+
+    def legacy_logs(self, task, level='INFO'):
+        """ write the logs the way older versions did """
+        logs_key = "{}:logs".format(task.key)
+        self.redis.zadd('logs:levels', 0, level)
+        self.redis.hset(logs_key, '1', 'a message')
+        self.redis.set("{}:index".format(logs_key), 1)
+        self.redis.rpush("{}:{}".format(logs_key, level), '1')
+        return logs_key
+
+    def assertNoKeys(self, task):
+        self.assertEqual(self.redis.keys("{}*".format(task.key)), [])
+
+    def test_remove_legacy_logs(self):
+        task = self.task('instance.reload', id='1')
+        self.legacy_logs(task)
+        self.legacy_logs(task, level='TRACE')
+        task.remove()
+        self.assertNoKeys(task)
+
+    def test_read_legacy_logs(self):
+        task = self.task('instance.reload', id='1')
+        logs_key = "{}:logs".format(task.key)
+        for index, (levelname, levelno, msg) in enumerate(
+                                    [('INFO', logging.INFO, 'started'),
+                                     ('DEBUG', logging.DEBUG, 'details'),
+                                     ('ERROR', logging.ERROR, 'failed')]):
+            self.redis.zadd('logs:levels', levelno, levelname)
+            self.redis.hset(logs_key, index + 1, msg)
+            self.redis.rpush("{}:{}".format(logs_key, levelname), index + 1)
+
+        self.assertEqual(task.get_logs('DEBUG'),
+                         ['started', 'details', 'failed'])
+        self.assertEqual(task.get_logs('INFO'), ['started', 'failed'])
+        self.assertEqual(task.tail_logs('DEBUG', 2), (['failed'], 3))
+
+    def test_flush_legacy_logs(self):
+        task = self.task('instance.reload', id='1')
+        self.legacy_logs(task, level='TRACE')
+        self.assertEqual(Task.flush(redis_client=self.redis), 1)
+        self.assertNoKeys(task)
+        self.assertFalse(self.redis.exists('logs:levels'))
+
+
+class TaskScheduleTests(RedisTestsBase):
+
+    def setUp(self):
+        super(TaskScheduleTests, self).setUp()
+        self.schedule = TaskSchedule(self.redis)
+        self.queue = TaskQueue(self.redis)
+
+    def test_add(self):
+        task = self.task('instance.reload', id='1')
+        id_ = self.schedule.add(task, run_at=1000)
+        self.assertEqual(len(self.schedule), 1)
+        self.assertEqual(self.retrieve(task.uuid).status,
+                         taskstatus.SCHEDULED)
+        self.assertEqual(self.schedule.due(10, now=999), [])
+        self.assertEqual(self.schedule.due(10, now=1000), [id_])
+
+    def test_promote_once(self):
+        task = self.task('instance.reload', id='1')
+        id_ = self.schedule.add(task, run_at=1000)
+        self.assertEqual(self.schedule.promote(id_, self.queue, now=1000),
+                         task.uuid)
+        self.assertEqual(self.queue.waiting(), [task.uuid])
+        self.assertEqual(len(self.schedule), 0)
+        # already promoted
+        self.assertIsNone(self.schedule.promote(id_, self.queue, now=1000))
+
+    def test_promote_periodic(self):
+        task = self.task('instance.reload', id='1')
+        id_ = self.schedule.add(task, run_at=1000, every=60)
+        self.assertEqual(self.schedule.promote(id_, self.queue, now=1130),
+                         task.uuid)
+        following = self.redis.hget(self.schedule.schedule_key(id_), 'next')
+        self.assertNotEqual(following, task.uuid)
+        following = self.retrieve(following)
+        self.assertEqual(following.status, taskstatus.SCHEDULED)
+        self.assertEqual(following['_arg.id'], '1')
+        # the occurrences missed in the meantime are skipped
+        self.assertEqual(self.schedule.due(10, now=1179), [])
+        self.assertEqual(self.schedule.due(10, now=1180), [id_])
+
+    def test_promote_max_concurrency(self):
+        task = self.task('instance.reload', id='1')
+        id_ = self.schedule.add(task, run_at=1000, every=60,
+                                max_concurrency=1)
+        self.schedule.promote(id_, self.queue, now=1000)
+        # the first occurrence is still queued
+        self.assertIsNone(self.schedule.promote(id_, self.queue, now=1060,
+                                                retry=5))
+        self.assertEqual(self.schedule.due(10, now=1064), [])
+        self.assertEqual(self.schedule.due(10, now=1065), [id_])
+        self.assertEqual(self.queue.waiting(), [task.uuid])
+
+    def test_cancel(self):
+        task = self.task('instance.reload', id='1')
+        id_ = self.schedule.add(task, run_at=1000, every=60)
+        self.schedule.promote(id_, self.queue, now=1000)
+        following = self.redis.hget(self.schedule.schedule_key(id_), 'next')
+        # the first occurrence has run
+        self.retrieve(task.uuid).update(status=taskstatus.FINISHED)
+        self.assertTrue(self.schedule.cancel(id_))
+        self.assertEqual(len(self.schedule), 0)
+        self.assertEqual(self.retrieve(following).status,
+                         taskstatus.CANCELLED)
+        self.assertFalse(self.schedule.cancel(id_))
+
+
+class TaskQueueTests(RedisTestsBase):
+
+    def setUp(self):
+        super(TaskQueueTests, self).setUp()
+        self.queue = TaskQueue(self.redis)
+
+    def push(self, command='instance.reload', priority='normal', **args):
+        task = self.task(command, priority=priority, **args)
+        self.queue.push(task)
+        return task
+
+    def test_push(self):
+        task = self.push(id='1')
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.waiting(), [task.uuid])
+        self.assertEqual(self.retrieve(task.uuid).status, taskstatus.QUEUED)
+
+    def test_push_pipeline(self):
+        pipe = self.redis.pipeline()
+        task = Task(redis_client=self.redis, pipeline=pipe,
+                    requested=datetime.datetime.now(),
+                    command='instance.reload', priority='normal',
+                    **{'_arg.id': '1'})
+        self.queue.push(task, pipeline=pipe)
+        # nothing is written until the transaction is executed
+        self.assertFalse(self.redis.exists(task.key))
+        self.assertEqual(len(self.queue), 0)
+        pipe.execute()
+        self.assertEqual(self.queue.waiting(), [task.uuid])
+        self.assertEqual(self.retrieve(task.uuid).status, taskstatus.QUEUED)
+        self.assertEqual(self.retrieve(task.uuid).command_args, dict(id='1'))
+
+    def test_pop(self):
+        first = self.push(id='1')
+        second = self.push(id='2')
+        self.assertEqual(self.queue.pop(timeout=1), first.uuid)
+        self.assertEqual(self.queue.processing, [first.uuid])
+        self.assertEqual(self.queue.pop(timeout=1), second.uuid)
+        self.assertIsNone(self.queue.pop(timeout=1))
+        self.queue.ack(first.uuid)
+        self.assertEqual(self.queue.processing, [second.uuid])
+
+    def test_requeue(self):
+        popped = self.push(id='1')
+        waiting = self.push(id='2')
+        self.queue.pop(timeout=1)
+        self.assertEqual(self.queue.requeue(), [popped.uuid])
+        self.assertEqual(self.queue.processing, [])
+        # in its original position
+        self.assertEqual(self.queue.waiting(), [popped.uuid, waiting.uuid])
+
+    def test_requeue_many(self):
+        first, second, third = [self.push(id=str(i)) for i in xrange(3)]
+        self.queue.pop(timeout=1)
+        self.queue.pop(timeout=1)
+        self.queue.requeue()
+        self.assertEqual(self.queue.waiting(),
+                         [first.uuid, second.uuid, third.uuid])
+
+    def test_pop_removed(self):
+        removed = self.push(id='1')
+        other = self.push(id='2')
+        self.redis.delete(removed.key)
+        self.assertEqual(self.queue.pop(timeout=1), other.uuid)
+        self.assertEqual(self.queue.processing, [other.uuid])
+
+    def test_flush(self):
+        self.push(id='1')
+        TaskSchedule(self.redis).add(self.task('instance.reload', id='2'),
+                                     run_at=1000)
+        self.assertEqual(Task.flush(redis_client=self.redis), 2)
+        self.assertEqual(self.redis.keys('tasks*'), [])
+
+    def test_requeue_deferred(self):
+        task = self.task('instance.reload', id='1')
+        task.status = taskstatus.DEFERRED
+        self.assertEqual(self.queue.requeue(), [task.uuid])
+        self.assertEqual(self.queue.waiting(), [task.uuid])
+        self.assertEqual(self.retrieve(task.uuid).status, taskstatus.QUEUED)
+
+    def test_remove(self):
+        removed = self.push(id='1')
+        other = self.push(id='2')
+        self.assertTrue(self.queue.remove(removed))
+        self.assertEqual(self.queue.waiting(), [other.uuid])
+        self.queue.pop(timeout=1)
+        # already popped
+        self.assertFalse(self.queue.remove(other))
+
+    def test_lanes_order(self):
+        low = self.push(priority='low', id='1')
+        normal = self.push(id='2')
+        high = self.push(priority='high', id='3')
+        self.assertEqual(self.queue.waiting(),
+                         [high.uuid, normal.uuid, low.uuid])
+        self.assertEqual([self.queue.pop(timeout=1) for i in xrange(3)],
+                         [high.uuid, normal.uuid, low.uuid])
+
+    def test_wakeup_tokens(self):
+        for i in xrange(5):
+            self.push(id=str(i))
+        self.assertEqual(self.redis.llen(self.queue.wakeup_key), 1)
+
+
+class TaskFailTests(RedisTestsBase):
+
+    def test_fail(self):
+        task = self.task('instance.reload', id='1')
+        Task.fail(task.uuid, 'Worker died', redis_client=self.redis)
+        task = self.retrieve(task.uuid)
+        self.assertEqual(task.status, taskstatus.FAILED)
+        self.assertEqual(task['result'], 'Worker died')
+
+    def test_fail_done(self):
+        task = self.task('instance.reload', id='1')
+        task.update(status=taskstatus.FINISHED, result='ok')
+        Task.fail(task.uuid, 'Worker died', redis_client=self.redis)
+        task = self.retrieve(task.uuid)
+        self.assertEqual(task.status, taskstatus.FINISHED)
+        self.assertEqual(task['result'], 'ok')